@@ -1,4 +1,38 @@
-from .aws_iam import *
-from .aws_s3 import *
-from .aws_sns import *
-from .aws_sqs import *
\ No newline at end of file
+import importlib
+
+# name -> submodule, the submodule (and boto3 with it) is only imported once the name is used
+_EXPORTS = {
+    "aws_checkpoint": ("CHECKPOINTS", "Checkpoint", "ResumableUpload", "RangedDownload", "part_length",
+                       "write_at", "abort_upload", "clean_orphans"),
+    "aws_consumer": ("SqsConsumer",),
+    "aws_events": ("EVENTS_FILE", "client_id", "EventQueue"),
+    "aws_fleet": ("FleetTemplate", "FleetPolicy", "FleetAutoscaler"),
+    "aws_iam": ("iam_client", "iam_resource", "current_user_arn", "create_user", "get_user", "list_users",
+                "create_group", "list_groups", "create_policy", "attach_user_policy", "attach_group_policy",
+                "add_user_to_group"),
+    "aws_ledger": ("TaskLedger",),
+    "aws_producer": ("SqsProducer",),
+    "aws_s3": ("default_region", "SIZE_UNIT", "convert_unit", "get_file_size", "file_etag", "S3Handler"),
+    "aws_sns": ("sns_resource", "sns_logger", "TOPICS_FILE", "TOPICS_TTL", "TopicIndex", "create_topic",
+                "list_topics", "get_topic", "create_or_get_topic", "delete_topic", "subscribe", "list_subscriptions",
+                "add_subscription_filter", "delete_subscription", "publish_message"),
+    "aws_sqs": ("CLAIM_ATTRIBUTE", "ClaimCheck", "SqsHandler"),
+    "aws_transfer": ("MB", "THROUGHPUT_FILE", "TUNING_FILE", "record_throughput", "measured_throughput",
+                     "network_id", "TransferProfile", "TransferTuner", "TransferStats", "TransferMeter",
+                     "MultipartWriter"),
+}
+_MODULES = {name: module for module, names in _EXPORTS.items() for name in names}
+
+__all__ = sorted(_MODULES)
+
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    value = getattr(importlib.import_module("." + _MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -1,5 +1,7 @@
 import logging
+import os
 import sys
+import threading
 
 import boto3
 from botocore.config import Config
@@ -8,47 +10,88 @@ from utils.Meta import Singleton
 
 @Singleton
 class AWSBackend:
+    """Process wide registry of boto3 sessions, clients and resources.
+
+    Everything is created lazily once per (service, region, profile) and reused, so TLS
+    connections stay in the pools instead of being set up per handler or per call. Clients
+    are thread-safe and shared by all threads; resources are not, so each thread gets its own.
+    region=None means the session's default region.
+    """
+
     def __init__(self):
         self._logger = logging.getLogger(AWSBackend.__class__.__name__)
+        logging.getLogger("botocore").setLevel(logging.CRITICAL)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._sessions = {}
+        self._clients = {}
+        self._regions = {}
+        self._max_pool_connections = int(os.environ.get("AWSRUN_MAX_POOL_CONNECTIONS", 32))
+        self._tcp_keepalive = True
+
+    def configure(self, max_pool_connections=None, tcp_keepalive=None):
+        """Tune the connection pools, only clients created afterwards are affected"""
+        with self._lock:
+            if max_pool_connections is not None:
+                self._max_pool_connections = max_pool_connections
+            if tcp_keepalive is not None:
+                self._tcp_keepalive = tcp_keepalive
+
+    def _config(self):
+        settings = dict(read_timeout=60, connect_timeout=5, retries={"max_attempts": 10},
+                        max_pool_connections=self._max_pool_connections)
+        try:
+            return Config(tcp_keepalive=self._tcp_keepalive, **settings)
+        except TypeError:
+            return Config(**settings)  # botocore predating tcp_keepalive
+
+    def _session(self, profile, region):
+        key = (profile, region)
+        with self._lock:
+            if key not in self._sessions:
+                session_data = {}
+                if region:
+                    session_data["region_name"] = region
+                if profile:
+                    session_data["profile_name"] = profile
+                self._sessions[key] = boto3.Session(**session_data)
+            return self._sessions[key]
 
     def get_available_regions(self, service: str):
         """AWS exposes their list of regions as an API. Gather the list."""
-        regions = boto3.session.Session().get_available_regions(service)
-        self._logger.debug(
-            "The service %s does not have available regions. Returning us-west-1 as default"
-        )
-        if not regions:
-            regions = ["us-west-1"]
-        return regions
+        with self._lock:
+            if service not in self._regions:
+                regions = boto3.session.Session().get_available_regions(service)
+                if not regions:
+                    self._logger.debug(
+                        "The service %s does not have available regions. Returning us-west-1 as default", service
+                    )
+                    regions = ["us-west-1"]
+                self._regions[service] = regions
+            return self._regions[service]
 
     def get_client(self, service: str, profile: str = None, region: str = 'us-west-1') -> boto3.Session.client:
-        """Get a boto3 client for a given service"""
-        logging.getLogger("botocore").setLevel(logging.CRITICAL)
-        session_data = {"region_name": region}
-        if profile:
-            session_data["profile_name"] = profile
-        session = boto3.Session(**session_data)
-        if region not in self.get_available_regions(service):
-            self._logger.debug(f"The service {service} is not available in this region!")
-            sys.exit()
-        config = Config(read_timeout=5, connect_timeout=5, retries={"max_attempts": 10})
-        client = session.client(service, config=config)
-        self._logger.debug(
-            f"{client.meta.endpoint_url} in {client.meta.region_name}: boto3 client login successful"
-        )
-        return client
+        """Get the shared boto3 client for a given service"""
+        key = (service, region, profile)
+        with self._lock:
+            if key not in self._clients:
+                if region and region not in self.get_available_regions(service):
+                    self._logger.debug(f"The service {service} is not available in this region!")
+                    sys.exit()
+                client = self._session(profile, region).client(service, config=self._config())
+                self._logger.debug(
+                    f"{client.meta.endpoint_url} in {client.meta.region_name}: boto3 client login successful"
+                )
+                self._clients[key] = client
+            return self._clients[key]
 
     def get_resource(self,
             service: str, profile: str = None, region: str = "us-west-1"
     ) -> boto3.Session.resource:
-        """Get a boto3 resource for a given service"""
-        logging.getLogger("botocore").setLevel(logging.CRITICAL)
-        session_data = {"region_name": region}
-        if profile:
-            session_data["profile_name"] = profile
-        session = boto3.Session(**session_data)
-
-        resource = session.resource(service)
-        return resource
-
-
+        """Get this thread's boto3 resource for a given service"""
+        key = (service, region, profile)
+        resources = self._local.__dict__.setdefault("resources", {})
+        if key not in resources:
+            with self._lock:
+                resources[key] = self._session(profile, region).resource(service, config=self._config())
+        return resources[key]
@@ -0,0 +1,380 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from botocore.exceptions import ClientError
+
+from aws.aws_transfer import MB, TransferMeter, TransferTuner, record_throughput
+from utils.store import state_dir, load_json, save_json
+
+CHECKPOINTS = "checkpoints"
+
+
+class Checkpoint:
+    """Progress of one transfer (kind, bucket, key, local file), kept in the state folder"""
+    MAX_AGE = 7 * 24 * 3600
+
+    def __init__(self, kind, bucket_name, object_key, local_path):
+        self._ident = {"kind": kind, "bucket": bucket_name, "key": object_key, "path": os.path.abspath(local_path)}
+        name = hashlib.sha1("\0".join(self._ident.values()).encode()).hexdigest()
+        self.path = os.path.join(state_dir(CHECKPOINTS), name + ".json")
+        self._lock = threading.Lock()
+
+    def load(self):
+        state = load_json(self.path)
+        # a hash collision or a foreign file is as good as no checkpoint
+        return state if state and all(state.get(k) == v for k, v in self._ident.items()) else None
+
+    def save(self, state):
+        state.update(self._ident)
+        state["saved"] = time.time()
+        with self._lock:
+            save_json(self.path, state)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @staticmethod
+    def stale(max_age=MAX_AGE):
+        """(path, state) of the checkpoints nobody came back for"""
+        folder = state_dir(CHECKPOINTS)
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            state = load_json(path)
+            if state is None or time.time() - state.get("saved", 0) > max_age:
+                yield path, state
+
+
+class ResumableUpload:
+    """Multipart upload of a file whose upload id and finished parts survive the process.
+
+    Re-running it for the same file and key picks the upload up again: S3's own list of
+    parts tells what is done, the file must still have the size and mtime it had. The part
+    size is fixed for the life of the upload, concurrency may follow a tuner.
+    """
+    MAX_PARTS = 10000
+
+    def __init__(self, client, bucket_name, object_key, local_file_path, extra_args=None, part_size=8 * MB,
+                 concurrency=4, tuner: TransferTuner = None, meter: TransferMeter = None):
+        self._client = client
+        self._bucket = bucket_name
+        self._key = object_key
+        self._path = local_file_path
+        self._extra_args = extra_args or {}
+        # upload_part needs the customer key again, nothing else of the object settings
+        self._part_args = {k: v for k, v in self._extra_args.items() if k.startswith("SSECustomer")}
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._tuner = tuner
+        self._meter = meter
+        self._checkpoint = Checkpoint("upload", bucket_name, object_key, local_file_path)
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(ResumableUpload.__name__)
+
+    def _uploaded_parts(self, upload_id):
+        """part number -> ETag of what S3 holds for the upload, None if the upload is gone"""
+        parts = {}
+        try:
+            paginator = self._client.get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self._bucket, Key=self._key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    parts[part['PartNumber']] = part['ETag']
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("NoSuchUpload", "404"):
+                return None
+            raise error
+        return parts
+
+    def _start(self, stat):
+        state = self._checkpoint.load()
+        if state and state["size"] == stat.st_size and state["mtime"] == stat.st_mtime_ns:
+            parts = self._uploaded_parts(state["upload_id"])
+            if parts is not None:
+                self._logger.info("Resuming upload of %s, %d parts done", self._key, len(parts))
+                return state, parts
+        if state:
+            abort_upload(self._client, self._bucket, self._key, state["upload_id"])
+        part_size = max(self._part_size, -(-stat.st_size // ResumableUpload.MAX_PARTS), 5 * MB)
+        response = self._client.create_multipart_upload(Bucket=self._bucket, Key=self._key, **self._extra_args)
+        state = {"upload_id": response['UploadId'], "part_size": part_size,
+                 "size": stat.st_size, "mtime": stat.st_mtime_ns, "parts": {}}
+        self._checkpoint.save(state)
+        return state, {}
+
+    def _upload_part(self, state, part_number, done):
+        offset = (part_number - 1) * state["part_size"]
+        with open(self._path, "rb") as f:
+            f.seek(offset)
+            body = f.read(state["part_size"])
+        started = time.monotonic()
+        response = self._client.upload_part(Bucket=self._bucket, Key=self._key, UploadId=state["upload_id"],
+                                            PartNumber=part_number, Body=body, **self._part_args)
+        elapsed = time.monotonic() - started
+        if self._tuner:
+            self._tuner.observe(len(body), elapsed)
+        if self._meter:
+            self._meter(len(body))
+            self._meter.part(elapsed)
+        with self._lock:
+            done[part_number] = response['ETag']
+            state["parts"] = {str(n): etag for n, etag in done.items()}
+            self._checkpoint.save(state)
+
+    def run(self):
+        stat = os.stat(self._path)
+        state, done = self._start(stat)
+        count = max(-(-stat.st_size // state["part_size"]), 1)
+        missing = [n for n in range(1, count + 1) if n not in done]
+        slots = threading.Condition()
+        inflight = [0]
+        failed = []
+
+        def release(future):
+            with slots:
+                inflight[0] -= 1
+                if not future.cancelled() and future.exception() is not None:
+                    failed.append(future)
+                slots.notify_all()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=TransferTuner.MAX_CONCURRENCY if self._tuner
+                                else self._concurrency) as pool:
+            futures = []
+            for part_number in missing:
+                with slots:
+                    # the tuner may change its mind about concurrency while we go
+                    slots.wait_for(lambda: failed or inflight[0] < (self._tuner.concurrency if self._tuner
+                                                                    else self._concurrency))
+                    if failed:
+                        # the upload failed already, the parts done so far stay checkpointed
+                        break
+                    inflight[0] += 1
+                future = pool.submit(self._upload_part, state, part_number, done)
+                future.add_done_callback(release)
+                futures.append(future)
+            for future in futures:
+                future.cancel()
+            for future in futures:
+                # a failed part leaves the upload and its checkpoint for the next run
+                if not future.cancelled():
+                    future.result()
+        self._client.complete_multipart_upload(
+            Bucket=self._bucket, Key=self._key, UploadId=state["upload_id"],
+            MultipartUpload={'Parts': [{'PartNumber': n, 'ETag': done[n]} for n in sorted(done)]})
+        self._checkpoint.remove()
+        record_throughput("upload", sum(part_length(state, n - 1) for n in missing), time.monotonic() - started)
+        if self._tuner:
+            self._tuner.save()
+        return stat.st_size
+
+
+class RangedDownload:
+    """Downloads an object as concurrent byte ranges into a preallocated <path>.part, renamed once complete.
+
+    The finished ranges are checkpointed, a re-run continues with the missing ones as long
+    as the object still has the same ETag (every range GET insists on it with IfMatch).
+    Ranges that take longer than HEDGE_FACTOR times the HEDGE_PERCENTILE of the finished ones
+    get a second, hedged request; whichever finishes first wins and the other one's connection
+    is closed. Both write the same bytes to the same place, so it does not matter which one got further.
+    """
+    HEDGE_PERCENTILE = 90
+    HEDGE_FACTOR = 1.5
+    HEDGE_MIN_SAMPLES = 4
+    RETRIES = 2
+    CHUNK = 256 * 1024
+
+    def __init__(self, client, bucket_name, object_key, target_path, extra_args=None, part_size=8 * MB,
+                 concurrency=4, meter: TransferMeter = None, hedge=True):
+        self._client = client
+        self._bucket = bucket_name
+        self._key = object_key
+        self._path = target_path
+        self._extra_args = extra_args or {}
+        self._part_size = part_size
+        self._concurrency = concurrency
+        self._meter = meter
+        self._hedge = hedge
+        self._checkpoint = Checkpoint("download", bucket_name, object_key, target_path)
+        self._finished = set()
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self.hedged = 0
+        self._logger = logging.getLogger(RangedDownload.__name__)
+
+    @property
+    def partial(self):
+        return self._path + ".part"
+
+    def _start(self, size, etag):
+        state = self._checkpoint.load()
+        if state and state["etag"] == etag and state["size"] == size and os.path.exists(self.partial):
+            return state
+        state = {"etag": etag, "size": size, "part_size": self._part_size, "done": []}
+        folder = os.path.dirname(os.path.abspath(self._path))
+        os.makedirs(folder, exist_ok=True)
+        with open(self.partial, "wb") as f:
+            f.truncate(size)
+            if size and hasattr(os, "posix_fallocate"):
+                # reserve the blocks now, a full disk fails here and not halfway through
+                os.posix_fallocate(f.fileno(), 0, size)
+        self._checkpoint.save(state)
+        return state
+
+    def _fetch(self, state, index, fd):
+        """One attempt at a range, False if another attempt finished it first"""
+        if index in self._finished:
+            return False
+        offset = index * state["part_size"]
+        last = offset + part_length(state, index) - 1
+        started = time.monotonic()
+        body = self._client.get_object(Bucket=self._bucket, Key=self._key, IfMatch=state["etag"],
+                                       Range="bytes={0}-{1}".format(offset, last), **self._extra_args)['Body']
+        with self._lock:
+            self._bodies.setdefault(index, []).append(body)
+        try:
+            for chunk in iter(lambda: body.read(RangedDownload.CHUNK), b""):
+                if index in self._finished:
+                    return False
+                write_at(fd, chunk, offset)
+                offset += len(chunk)
+                if self._meter:
+                    self._meter(len(chunk))
+        finally:
+            with self._lock:
+                self._bodies[index].remove(body)
+            body.close()
+        if self._meter:
+            self._meter.part(time.monotonic() - started)
+        return True
+
+    def _settle(self, index):
+        """The range is done, the connections of other attempts at it are cut"""
+        self._finished.add(index)
+        with self._lock:
+            losers = list(self._bodies.get(index, []))
+        for body in losers:
+            body.close()
+
+    def _hedge_after(self, latencies):
+        if not self._hedge or len(latencies) < RangedDownload.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(latencies)
+        return RangedDownload.HEDGE_FACTOR * \
+            ordered[min(len(ordered) * RangedDownload.HEDGE_PERCENTILE // 100, len(ordered) - 1)]
+
+    def run(self, size, etag):
+        state = self._start(size, etag)
+        count = -(-size // state["part_size"])
+        missing = sorted(set(range(count)) - set(state["done"]))
+        queue = list(reversed(missing))
+        started = time.monotonic()
+        attempts = {}  # future -> range index
+        running = {}  # range index -> (start time, hedged)
+        latencies = []
+        failures = {}
+        fd = os.open(self.partial, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        try:
+            with ThreadPoolExecutor(max_workers=self._concurrency + max(1, self._concurrency // 4)) as pool:
+                try:
+                    while queue or attempts:
+                        while queue and len(running) < self._concurrency:
+                            index = queue.pop()
+                            running[index] = (time.monotonic(), False)
+                            attempts[pool.submit(self._fetch, state, index, fd)] = index
+                        done, _ = wait(list(attempts), timeout=0.05, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            index = attempts.pop(future)
+                            if index in self._finished:
+                                continue  # the loser of a hedge
+                            if future.exception() is not None:
+                                if index in attempts.values():
+                                    continue  # the other attempt may still make it
+                                failures[index] = failures.get(index, 0) + 1
+                                if failures[index] > RangedDownload.RETRIES:
+                                    raise future.exception()
+                                # a dropped connection mid body is not retried by botocore
+                                running.pop(index)
+                                queue.append(index)
+                                continue
+                            self._settle(index)
+                            latencies.append(time.monotonic() - running.pop(index)[0])
+                            state["done"].append(index)
+                            self._checkpoint.save(state)
+                        threshold = self._hedge_after(latencies)
+                        if threshold is None:
+                            continue
+                        now = time.monotonic()
+                        for index, (since, hedged) in list(running.items()):
+                            if not hedged and now - since > threshold:
+                                running[index] = (since, True)
+                                self.hedged += 1
+                                attempts[pool.submit(self._fetch, state, index, fd)] = index
+                except BaseException:
+                    # pending attempts see their range finished and stop, so the pool can shut down
+                    for index in range(count):
+                        self._settle(index)
+                    raise
+        finally:
+            os.close(fd)
+        if self.hedged:
+            self._logger.debug("Hedged %d of %d ranges of %s", self.hedged, len(missing), self._key)
+        os.replace(self.partial, self._path)
+        self._checkpoint.remove()
+        record_throughput("download", sum(part_length(state, i) for i in missing), time.monotonic() - started)
+        return size
+
+
+_write_lock = threading.Lock()
+
+
+def part_length(state, index):
+    return max(min(state["part_size"], state["size"] - index * state["part_size"]), 0)
+
+
+def write_at(fd, data, offset):
+    if hasattr(os, "pwrite"):
+        os.pwrite(fd, data, offset)
+    else:
+        with _write_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+
+
+def abort_upload(client, bucket_name, object_key, upload_id):
+    try:
+        client.abort_multipart_upload(Bucket=bucket_name, Key=object_key, UploadId=upload_id)
+    except ClientError as error:
+        if error.response["Error"]["Code"] not in ("NoSuchUpload", "404"):
+            raise error
+
+
+def clean_orphans(client, bucket_name, prefix=None, max_age=Checkpoint.MAX_AGE):
+    """Aborts the multipart uploads that will never be completed: those of stale local checkpoints
+    and, only with a prefix, any under it started more than max_age seconds ago that no local
+    checkpoint still refers to. Returns the aborted keys.
+
+    The bucket is shared and other machines keep their checkpoints to themselves, so the sweep
+    is limited to a prefix the caller owns.
+    """
+    aborted = []
+    for path, state in list(Checkpoint.stale(max_age)):
+        if state and state.get("kind") == "upload" and state.get("bucket") == bucket_name:
+            abort_upload(client, bucket_name, state["key"], state["upload_id"])
+            aborted.append(state["key"])
+        os.remove(path)
+    if prefix is None:
+        return aborted
+    pending = {load_json(os.path.join(state_dir(CHECKPOINTS), name), {}).get("upload_id")
+               for name in os.listdir(state_dir(CHECKPOINTS))}
+    cutoff = time.time() - max_age
+    paginator = client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for upload in page.get('Uploads', []):
+            if upload['UploadId'] not in pending and upload['Initiated'].timestamp() < cutoff:
+                abort_upload(client, bucket_name, upload['Key'], upload['UploadId'])
+                aborted.append(upload['Key'])
+    return aborted
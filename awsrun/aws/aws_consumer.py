@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from aws.aws_sqs import SqsHandler
+
+
+class SqsConsumer:
+    """Drains a queue by calling handler(message) for each message, SqsHandler.body gives its body.
+
+    receivers threads long-poll and pass the messages to a pool of workers threads. They only ask
+    for as many messages as there are free slots (workers + prefetch), so slow handlers slow the
+    polling down instead of hiding messages other consumers could take. Handled messages are
+    deleted in batches of 10, or once delete_interval seconds passed, and the visibility timeout
+    of messages still waiting or being handled is extended until they are done. A handler that
+    raises leaves its message in the queue, it is received again once its timeout runs out.
+    """
+    BATCH = 10
+
+    def __init__(self, sqs: SqsHandler, queue, handler, receivers=2, workers=8, prefetch=None,
+                 visibility=30, delete_interval=1.0, wait=20):
+        self._sqs = sqs
+        self._queue = queue
+        self._handler = handler
+        self._receivers = receivers
+        self._workers = workers
+        self._capacity = workers + (workers if prefetch is None else prefetch)
+        self._visibility = visibility
+        self._delete_interval = delete_interval
+        self._wait = wait
+        self._logger = logging.getLogger(SqsConsumer.__name__)
+        self._slots = threading.Condition()
+        self._held = 0
+        self._lock = threading.Lock()
+        # receipt handle -> [message, when its visibility was last set]
+        self._pending = {}
+        self._acks = []
+        self._acked = 0
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._last_received = time.monotonic()
+        self.handled = 0
+        self.failed = 0
+
+    def stop(self):
+        self._stop.set()
+        with self._slots:
+            self._slots.notify_all()
+
+    def _reserve(self):
+        """Waits for free slots and takes up to a batch of them, none once stopped"""
+        with self._slots:
+            self._slots.wait_for(lambda: self._held < self._capacity or self._stop.is_set())
+            if self._stop.is_set():
+                return 0
+            wanted = min(SqsConsumer.BATCH, self._capacity - self._held)
+            self._held += wanted
+            return wanted
+
+    def _release(self, count):
+        with self._slots:
+            self._held -= count
+            self._slots.notify_all()
+
+    def _receive(self, pool):
+        while True:
+            wanted = self._reserve()
+            if not wanted:
+                return
+            try:
+                messages = self._sqs.receive_messages(self._queue, wanted, wait_time=self._wait,
+                                                      visibility_timeout=self._visibility)
+            except (ClientError, BotoCoreError):
+                # throttled or the network is down, the slots go back and the poll is tried again
+                self._logger.warning("Receive failed, retrying", exc_info=True)
+                self._release(wanted)
+                self._stop.wait(1)
+                continue
+            except BaseException:
+                self._release(wanted)
+                raise
+            self._release(wanted - len(messages))
+            now = time.monotonic()
+            if messages:
+                self._last_received = now
+            with self._lock:
+                for message in messages:
+                    self._pending[message.receipt_handle] = [message, now]
+            for message in messages:
+                pool.submit(self._handle, message)
+
+    def _handle(self, message):
+        try:
+            self._handler(message)
+        except Exception:
+            self._logger.exception("Handler failed on message %s", message.message_id)
+            with self._lock:
+                self._pending.pop(message.receipt_handle, None)
+                self.failed += 1
+        else:
+            with self._lock:
+                self._pending.pop(message.receipt_handle, None)
+                self.handled += 1
+                if not self._acks:
+                    self._acked = time.monotonic()
+                self._acks.append(message)
+                full = len(self._acks) >= SqsConsumer.BATCH
+            if full:
+                self._flush()
+        finally:
+            self._release(1)
+
+    def _flush(self, force=True):
+        with self._lock:
+            if not self._acks or not force and time.monotonic() - self._acked < self._delete_interval:
+                return
+            acks, self._acks = self._acks, []
+        failed = []
+        for i in range(0, len(acks), SqsConsumer.BATCH):
+            batch = acks[i:i + SqsConsumer.BATCH]
+            try:
+                response = self._sqs.delete_messages(self._queue, batch)
+            except (ClientError, BotoCoreError):
+                response = None
+            if response is None:
+                # delete_messages logs a ClientError and returns nothing
+                failed += batch
+                continue
+            for msg_meta in response.get('Failed', []):
+                if msg_meta.get('SenderFault'):
+                    # e.g. an expired receipt handle, the message is received again anyway
+                    self._logger.warning("Message %s may be handled twice: %s",
+                                         batch[int(msg_meta['Id'])].message_id, msg_meta.get('Code'))
+                else:
+                    failed.append(batch[int(msg_meta['Id'])])
+        if failed:
+            # tried again on the next tick, while their visibility holds they are not handled twice
+            self._logger.warning("Couldn't delete %d handled messages, retrying", len(failed))
+            with self._lock:
+                if not self._acks:
+                    self._acked = time.monotonic()
+                self._acks = failed + self._acks
+
+    def _extend(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [entry for entry in self._pending.values() if now - entry[1] >= self._visibility / 2]
+            for entry in due:
+                entry[1] = now
+        messages = [message for message, _ in due]
+        for i in range(0, len(messages), SqsConsumer.BATCH):
+            try:
+                failed = self._sqs.change_visibility(self._queue, messages[i:i + SqsConsumer.BATCH],
+                                                     self._visibility)
+            except (ClientError, BotoCoreError):
+                continue
+            for message in failed:
+                self._logger.warning("Message %s may be handled twice, its visibility was not extended",
+                                     message.message_id)
+
+    def _housekeep(self):
+        tick = min(self._delete_interval, self._visibility / 4)
+        while not self._done.wait(tick):
+            try:
+                self._flush(force=False)
+                self._extend()
+            except Exception:
+                # the keeper must live on, or the visibility of what is held runs out
+                self._logger.exception("Housekeeping failed")
+
+    def run(self, idle=None):
+        """Consumes until stop() (or nothing arrived for idle seconds), then finishes what it holds.
+
+        Returns the number of messages handled.
+        """
+        keeper = threading.Thread(target=self._housekeep, daemon=True)
+        keeper.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                receivers = [threading.Thread(target=self._receive, args=(pool,), daemon=True)
+                             for _ in range(self._receivers)]
+                for receiver in receivers:
+                    receiver.start()
+                try:
+                    while not self._stop.wait(0.5):
+                        with self._lock:
+                            busy = bool(self._pending)
+                        if idle is not None and not busy and time.monotonic() - self._last_received > idle:
+                            break
+                        if not any(receiver.is_alive() for receiver in receivers):
+                            self._logger.error("All receivers died, stopping")
+                            break
+                finally:
+                    self.stop()
+                    # a receiver in a long poll returns within wait seconds
+                    for receiver in receivers:
+                        receiver.join()
+        finally:
+            self._done.set()
+            keeper.join()
+            self._flush()
+        return self.handled
@@ -1,10 +1,12 @@
+from __future__ import annotations
+
 import datetime
 import json
 import logging
 import re
 import sys
 import time
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
 import boto3
 import botocore.exceptions
@@ -14,9 +16,11 @@ from aws import iam_client
 from aws.aws_backend import AWSBackend
 from utils.Meta import Singleton
 from utils.constant import Const
-from boto3_type_annotations.ec2 import Client, ServiceResource, Instance
 from botocore.exceptions import ClientError
 
+if TYPE_CHECKING:
+    from boto3_type_annotations.ec2 import Client, ServiceResource, Instance
+
 
 class VPCManager:
     def __init__(self):
@@ -388,9 +392,13 @@ class InstanceState(Const):
 @Singleton
 class EC2InstHelper:
     def __init__(self):
-        self._ec2res: ServiceResource = AWSBackend().get_resource(service='ec2')
+        # clients are thread-safe and shared, resources are not: _ec2res gives the calling thread's own
         self._ec2cli: Client = AWSBackend().get_client(service='ec2')
 
+    @property
+    def _ec2res(self) -> ServiceResource:
+        return AWSBackend().get_resource(service='ec2')
+
     def _get_instance_state(self, inst_id):
         for instance in self._ec2res.instances.all():
             if instance.id == inst_id:
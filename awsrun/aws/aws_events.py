@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from typing import TYPE_CHECKING
+
+from botocore.exceptions import ClientError
+
+from aws.aws_sns import sns_resource, subscribe, add_subscription_filter
+from aws.aws_sqs import SqsHandler
+from utils.store import state_dir, load_json, save_json
+
+if TYPE_CHECKING:
+    from boto3_type_annotations.sqs import Queue
+
+EVENTS_FILE = "events.json"
+
+
+def client_id():
+    """Stable id of this machine/user, completion events are filtered on it"""
+    path = os.path.join(state_dir(), EVENTS_FILE)
+    state = load_json(path, {})
+    if "client" not in state:
+        state["client"] = uuid.uuid4().hex
+        save_json(path, state)
+    return state["client"]
+
+
+class EventQueue:
+    """Per-client SQS queue subscribed to an SNS topic, receiving only the messages whose
+    'client' attribute matches this client.
+
+    The queue and its subscription are set up once and remembered in the state folder,
+    later runs only long-poll it.
+    """
+    WAIT_SECONDS = 20
+    RETENTION_SECONDS = 900
+
+    def __init__(self, location, topic_arn):
+        self._sqs = SqsHandler(location)
+        self._location = location
+        self._topic_arn = topic_arn
+        self._client = client_id()
+        self._path = os.path.join(state_dir(), EVENTS_FILE)
+        self._logger = logging.getLogger(EventQueue.__class__.__name__)
+        # one thread polls at a time, the buffer lock guards what it received for the others
+        self._lock = threading.Lock()
+        self._buffer = threading.Lock()
+        self._waiters = []
+        self._received = {}
+        known = load_json(self._path, {}).get("topics", {}).get(topic_arn)
+        self._queue: Queue = self._sqs.get_queue_by_url(known) if known else self._setup()
+
+    @property
+    def client(self):
+        return self._client
+
+    def _setup(self):
+        name = "awsrun-events-" + self._client
+        queue: Queue = self._sqs.get_queue(name, False) or self._sqs.create_queue(name, {
+            "ReceiveMessageWaitTimeSeconds": str(EventQueue.WAIT_SECONDS),
+            "MessageRetentionPeriod": str(EventQueue.RETENTION_SECONDS)
+        })
+        queue_arn = queue.attributes["QueueArn"]
+        queue.set_attributes(Attributes={"Policy": json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Principal": {"Service": "sns.amazonaws.com"},
+                "Action": "sqs:SendMessage",
+                "Resource": queue_arn,
+                "Condition": {"ArnEquals": {"aws:SourceArn": self._topic_arn}}
+            }]
+        })})
+        subscription = subscribe(sns_resource(self._location).Topic(self._topic_arn), "sqs", queue_arn)
+        # the worker's json body arrives as is instead of wrapped in an SNS envelope
+        subscription.set_attributes(AttributeName="RawMessageDelivery", AttributeValue="true")
+        add_subscription_filter(subscription, {"client": self._client})
+        state = load_json(self._path, {})
+        state.setdefault("topics", {})[self._topic_arn] = queue.url
+        save_json(self._path, state)
+        return queue
+
+    def _take(self, match):
+        with self._buffer:
+            taken = [key for key, (body, _) in self._received.items() if match(body)]
+            messages = [self._received.pop(key)[1] for key in taken]
+        for message in messages:
+            self._sqs.delete_message(message)
+        return bool(messages)
+
+    def _sort(self, messages):
+        """Keeps the messages a waiter of this process wants, the others are released at once"""
+        unwanted, invalid = [], []
+        with self._buffer:
+            for message in messages:
+                try:
+                    body = json.loads(message.body)
+                except ValueError:
+                    invalid.append(message)
+                    continue
+                if any(match(body) for match in self._waiters):
+                    self._received[message.message_id] = (body, message)
+                else:
+                    unwanted.append(message)
+        for message in invalid:
+            self._sqs.delete_message(message)
+        self._release(unwanted)
+
+    def _release(self, messages):
+        """Makes messages visible again right away, other processes of this client share the queue"""
+        for i in range(0, len(messages), 10):
+            try:
+                self._sqs.change_visibility(self._queue, messages[i:i + 10], 0)
+            except ClientError:
+                # they show up again once their visibility timeout runs out
+                self._logger.warning("Couldn't release %d events", len(messages[i:i + 10]))
+
+    def _leave(self, match):
+        with self._buffer:
+            self._waiters.remove(match)
+            left = [key for key, (body, _) in self._received.items()
+                    if not any(waiter(body) for waiter in self._waiters)]
+            messages = [self._received.pop(key)[1] for key in left]
+        self._release(messages)
+
+    def wait(self, match, seconds):
+        """Long-polls up to seconds for a message whose json body satisfies match.
+
+        Several threads may wait at once: one of them polls while the others queue up on the
+        lock, and what it receives for them is kept until they pick it up. Matching messages
+        are consumed; messages no thread of this process waits for are made visible again at
+        once for the other processes of this client.
+        """
+        deadline = time.monotonic() + seconds
+        with self._buffer:
+            self._waiters.append(match)
+        try:
+            if not self._lock.acquire(timeout=max(0, seconds)):
+                return self._take(match)
+            try:
+                if self._take(match):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                try:
+                    # rounded up, a zero wait in the last second would turn the caller's loop into a busy poll
+                    messages = self._sqs.receive_messages(self._queue, 10,
+                                                          wait_time=min(EventQueue.WAIT_SECONDS,
+                                                                        math.ceil(remaining)))
+                except ClientError as error:
+                    if error.response["Error"]["Code"] not in ("AWS.SimpleQueueService.NonExistentQueue",
+                                                               "QueueDoesNotExist"):
+                        raise error
+                    self._logger.warning("Event queue is gone, setting it up again")
+                    self._queue = self._setup()
+                    return False
+                self._sort(messages)
+                return self._take(match)
+            finally:
+                self._lock.release()
+        finally:
+            self._leave(match)
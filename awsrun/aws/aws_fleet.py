@@ -0,0 +1,156 @@
+import logging
+import math
+import time
+
+from aws.aws_ec2 import EC2Launcher, InstanceState, InstanceType
+from aws.aws_sqs import SqsHandler
+
+ACTIVE = (InstanceState.status(InstanceState.PENDING), InstanceState.status(InstanceState.RUNNING))
+
+
+class FleetTemplate:
+    """What launch_instance needs to start more workers"""
+
+    def __init__(self, key_name, sg_id, subnet_id, img_id, instance_type: InstanceType, userdata=''):
+        self.key_name = key_name
+        self.sg_id = sg_id
+        self.subnet_id = subnet_id
+        self.img_id = img_id
+        self.instance_type = instance_type
+        self.userdata = userdata
+
+
+class FleetPolicy:
+    """Sizes the fleet so a task waits at most target_wait seconds in the queue.
+
+    task_seconds is the mean run time of a task and slots the tasks a worker runs at once.
+    The fleet stays within min_workers and max_workers, and under max_hourly_cost when the
+    hourly_price of a worker is known.
+    """
+
+    def __init__(self, target_wait=60, task_seconds=60, slots=1, min_workers=0, max_workers=10,
+                 max_hourly_cost=None, hourly_price=None, up_cooldown=60, down_cooldown=300, smoothing=0.3):
+        self.target_wait = target_wait
+        self.task_seconds = task_seconds
+        self.slots = slots
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.max_hourly_cost = max_hourly_cost
+        self.hourly_price = hourly_price
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.smoothing = smoothing
+
+    @property
+    def ceiling(self):
+        ceiling = self.max_workers
+        if self.max_hourly_cost is not None and self.hourly_price:
+            ceiling = min(ceiling, int(self.max_hourly_cost // self.hourly_price))
+        return ceiling
+
+    def workers(self, waiting, in_flight, arrival_rate):
+        """Workers needed for the current load.
+
+        The busy slots are the tasks in flight, or what the arrivals keep busy (Little's law:
+        arrival_rate * task_seconds) if that is more; on top of those, the waiting backlog must
+        drain within target_wait.
+        """
+        busy = max(in_flight, arrival_rate * self.task_seconds)
+        backlog = waiting * self.task_seconds / self.target_wait
+        wanted = math.ceil((busy + backlog) / self.slots)
+        # the cost cap wins over the minimum
+        return min(self.ceiling, max(self.min_workers, wanted))
+
+
+class FleetAutoscaler:
+    """Launches or terminates the instances tagged like the launcher's type_tag to follow the task queue.
+
+    Each step samples the queue depth (waiting and in flight), updates a smoothed arrival rate
+    and asks the policy for the fleet size. Growing waits up_cooldown since the last launch,
+    shrinking down_cooldown since any change. Pending instances go first, then the newest
+    running ones, never so many that the tasks in flight lose their workers. A terminated worker's task becomes visible again once
+    its visibility timeout runs out. With an intake queue, the tasks the scheduler holds back
+    there count as waiting too.
+    """
+
+    def __init__(self, launcher: EC2Launcher, sqs: SqsHandler, queue, template: FleetTemplate, policy: FleetPolicy,
+                 dry_run=False, intake=None):
+        self._launcher = launcher
+        self._sqs = sqs
+        self._queue = queue
+        self._template = template
+        self._policy = policy
+        self._dry_run = dry_run
+        self._intake = intake
+        self._logger = logging.getLogger(FleetAutoscaler.__name__)
+        self._last_up = -math.inf
+        self._last_down = -math.inf
+        self._previous = None
+        self.arrival_rate = 0.0
+
+    def workers(self):
+        """pending and running instances of the fleet, newest first"""
+        instances = [i for i in self._launcher.all_instances() if i.state['Name'] in ACTIVE]
+        return sorted(instances, key=lambda i: i.launch_time, reverse=True)
+
+    def _observe(self, waiting, in_flight, now):
+        if self._previous is not None:
+            then, was_waiting, was_in_flight = self._previous
+            elapsed = now - then
+            if elapsed > 0:
+                # what left the queue meanwhile is roughly what the busy slots finished
+                arrivals = max(0.0, waiting - was_waiting + was_in_flight * elapsed / self._policy.task_seconds)
+                self.arrival_rate += self._policy.smoothing * (arrivals / elapsed - self.arrival_rate)
+        self._previous = (now, waiting, in_flight)
+
+    def step(self):
+        """One sample and, cooldowns permitting, one adjustment. Returns (workers, desired workers)"""
+        now = time.monotonic()
+        waiting, in_flight = self._sqs.get_queue_depth(self._queue)
+        if self._intake is not None:
+            # held by the scheduler is in flight there, but still waiting for a worker
+            waiting += sum(self._sqs.get_queue_depth(self._intake))
+        self._observe(waiting, in_flight, now)
+        workers = self.workers()
+        current = len(workers)
+        desired = self._policy.workers(waiting, in_flight, self.arrival_rate)
+        self._logger.info("waiting %d, in flight %d, arrivals %.2f/s: %d workers, %d wanted",
+                          waiting, in_flight, self.arrival_rate, current, desired)
+        if desired > current and now - self._last_up >= self._policy.up_cooldown:
+            self._logger.info("Launching %d workers", desired - current)
+            if not self._dry_run:
+                template = self._template
+                self._launcher.launch_instance(template.key_name, template.sg_id, template.subnet_id,
+                                               template.img_id, template.instance_type, desired - current,
+                                               template.userdata)
+            self._last_up = now
+        elif desired < current and now - max(self._last_up, self._last_down) >= self._policy.down_cooldown:
+            retired = self.retirable(workers, in_flight)[:current - desired]
+            if retired:
+                self._logger.info("Terminating %s", ", ".join(instance.id for instance in retired))
+                if not self._dry_run:
+                    for instance in retired:
+                        instance.terminate()
+                self._last_down = now
+        return current, desired
+
+    def retirable(self, workers, in_flight):
+        """Workers that can go without killing a task, pending ones first, then the newest running ones.
+
+        Which running worker holds a task is not known here, so the running ones that go are at
+        most those beyond what the tasks in flight keep busy (in_flight / slots).
+        """
+        pending = [i for i in workers if i.state['Name'] == InstanceState.status(InstanceState.PENDING)]
+        running = [i for i in workers if i.state['Name'] != InstanceState.status(InstanceState.PENDING)]
+        busy = math.ceil(in_flight / self._policy.slots)
+        return pending + running[:max(0, len(running) - busy)]
+
+    def run(self, interval=30):
+        while True:
+            started = time.monotonic()
+            try:
+                self.step()
+            except Exception:
+                # a failed sample or launch is retried on the next step
+                self._logger.exception("Autoscaling step failed")
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
@@ -1,15 +1,21 @@
-import boto3
+from __future__ import annotations
+
 import json
-from boto3_type_annotations.iam import ServiceResource, Client
+from typing import TYPE_CHECKING
+
+from aws.aws_backend import AWSBackend
+
+if TYPE_CHECKING:
+    from boto3_type_annotations.iam import ServiceResource, Client
 
 
 def iam_client():
-    iam: Client = boto3.client('iam')
+    iam: Client = AWSBackend().get_client('iam', region=None)
     return iam
 
 
 def iam_resource():
-    iam: ServiceResource = boto3.resource('iam')
+    iam: ServiceResource = AWSBackend().get_resource('iam', region=None)
     return iam
 
 
@@ -0,0 +1,50 @@
+import json
+import time
+
+from aws.aws_s3 import S3Handler
+
+CLAIMED, DONE = "claimed", "done"
+
+
+class TaskLedger:
+    """Worker side record of the tasks run, one small object per task deduplication id in the bucket.
+
+    A worker claims a task before running it with a conditional PUT, so of two deliveries of the
+    same task only one runs, however far apart they come (a FIFO queue only deduplicates within
+    5 minutes, a standard queue not at all). A claim lapses after its lease, so the task of a
+    worker that died runs again elsewhere; finished tasks stay recorded until the bucket's
+    lifecycle rules remove them.
+    """
+    PREFIX = "ledger/"
+
+    def __init__(self, location, bucket, prefix=PREFIX):
+        self._s3 = S3Handler(location)
+        self._bucket = bucket
+        self._prefix = prefix
+
+    def _key(self, task_id):
+        return self._prefix + task_id
+
+    def claim(self, task_id, owner, lease):
+        """True if owner may run the task, False if it is done or another worker holds an unexpired claim"""
+        record = json.dumps({"state": CLAIMED, "owner": owner, "until": time.time() + lease}).encode()
+        key = self._key(task_id)
+        if self._s3.put_if(self._bucket, key, record):
+            return True
+        data, etag = self._s3.read_tagged(self._bucket, key)
+        if data is None:
+            # released in the meantime
+            return self._s3.put_if(self._bucket, key, record)
+        current = json.loads(data)
+        if current["state"] == DONE or current["until"] > time.time():
+            return False
+        # takes the lapsed claim over, unless another worker just did
+        return self._s3.put_if(self._bucket, key, record, etag)
+
+    def done(self, task_id, owner):
+        self._s3.write_object(self._bucket, self._key(task_id),
+                              json.dumps({"state": DONE, "owner": owner, "at": time.time()}).encode())
+
+    def release(self, task_id):
+        """The task failed, a redelivery may run it again"""
+        self._s3.delete_objects(self._bucket, [self._key(task_id)])
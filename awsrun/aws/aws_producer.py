@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError
+
+from aws.aws_sqs import SqsHandler
+
+
+class SqsProducer:
+    """Buffers messages for a queue and sends them in as few SendMessageBatch calls as the limits allow.
+
+    The buffer goes out once it holds max_buffer messages, or linger seconds after its first
+    message came in, split into batches that are sent in parallel. Only the entries SQS reports
+    as failed are sent again, with exponential backoff, unless the fault is the sender's. On a FIFO
+    queue the deduplication ids make those resends harmless.
+    send() returns a future of the message id; flush() waits for everything sent so far.
+    """
+    RETRIES = 5
+
+    def __init__(self, sqs: SqsHandler, queue, max_buffer=100, linger=0.05, senders=4, retries=RETRIES,
+                 backoff=0.1):
+        self._sqs = sqs
+        self._queue = queue
+        self._max_buffer = max_buffer
+        self._linger = linger
+        self._retries = retries
+        self._backoff = backoff
+        self._pool = ThreadPoolExecutor(max_workers=senders)
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._timer = None
+        self._batches = set()
+        self._failed = 0
+        self._closed = False
+
+    def send(self, body, attributes=None, group=None, dedup=None):
+        # parking a large body in S3 happens here, outside of the lock
+        body, attributes = self._sqs.prepare(body, attributes or {})
+        entry = dict({'MessageBody': body, 'MessageAttributes': attributes},
+                     **SqsHandler.fifo_args(self._queue, group, dedup))
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Producer is closed")
+            self._buffer.append((entry, future))
+            if len(self._buffer) >= self._max_buffer:
+                self._drain()
+            elif self._timer is None:
+                self._timer = threading.Timer(self._linger, self._linger_expired)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def _linger_expired(self):
+        with self._lock:
+            if self._buffer:
+                self._drain()
+
+    def _drain(self):
+        """Hands the buffer to the senders, the lock is held"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        buffered, self._buffer = self._buffer, []
+        for batch in SqsHandler.batches(buffered, entry=lambda item: item[0]):
+            sending = self._pool.submit(self._send, batch)
+            self._batches.add(sending)
+            sending.add_done_callback(self._batches.discard)
+
+    def _send(self, batch):
+        try:
+            self._attempt(batch)
+        except BaseException as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            raise
+
+    def _attempt(self, batch):
+        delay = self._backoff
+        for attempt in range(self._retries + 1):
+            entries = [dict(entry, Id=str(ind)) for ind, (entry, _) in enumerate(batch)]
+            try:
+                response = self._sqs.send_batch(self._queue, entries)
+            except ClientError as error:
+                # throttled or unreachable, the whole batch is tried again
+                code = error.response["Error"]["Code"]
+                response = {'Failed': [{'Id': entry['Id'], 'Code': code, 'SenderFault': False} for entry in entries]}
+            for msg_meta in response.get('Successful', []):
+                batch[int(msg_meta['Id'])][1].set_result(msg_meta['MessageId'])
+            retry = []
+            for msg_meta in response.get('Failed', []):
+                item = batch[int(msg_meta['Id'])]
+                if msg_meta.get('SenderFault') or attempt == self._retries:
+                    with self._lock:
+                        self._failed += 1
+                    item[1].set_exception(RuntimeError("Message not sent: {0}".format(msg_meta['Code'])))
+                else:
+                    retry.append(item)
+            if not retry:
+                return
+            batch = retry
+            time.sleep(delay * random.uniform(0.5, 1))
+            delay *= 2
+
+    def flush(self):
+        """Sends what is buffered and waits for all sends, RuntimeError if messages were lost since the last flush"""
+        with self._lock:
+            if self._buffer:
+                self._drain()
+            sending = list(self._batches)
+        wait(sending)
+        for future in sending:
+            future.result()
+        with self._lock:
+            failed, self._failed = self._failed, 0
+        if failed:
+            raise RuntimeError("{0} messages were not sent".format(failed))
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -1,13 +1,25 @@
+from __future__ import annotations
+
+import hashlib
 import os
 import json
+import posixpath
 import logging
-import sys
-import threading
-import boto3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
 import enum
-from boto3_type_annotations.s3 import ServiceResource, Bucket
 from botocore.exceptions import ClientError
 
+from aws.aws_backend import AWSBackend
+from aws.aws_checkpoint import ResumableUpload, RangedDownload, clean_orphans, Checkpoint
+
+from aws.aws_transfer import MultipartWriter, MB, record_throughput, TransferProfile, TransferMeter
+
+if TYPE_CHECKING:
+    from boto3_type_annotations.s3 import ServiceResource, Bucket
+
 default_region = 'us-west-1'
 
 
@@ -37,33 +49,23 @@ def get_file_size(file_name, size_type=SIZE_UNIT.MB):
     return convert_unit(size, size_type)
 
 
-class TransferProgress:
-    def __init__(self, target_size):
-        self._target_size = target_size
-        self._total_transferred = 0
-        self._lock = threading.Lock()
-        self.thread_info = {}
-
-    def __call__(self, bytes_transferred):
-        thread = threading.current_thread()
-        with self._lock:
-            self._total_transferred += bytes_transferred
-            if thread.ident not in self.thread_info.keys():
-                self.thread_info[thread.ident] = bytes_transferred
-            else:
-                self.thread_info[thread.ident] += bytes_transferred
-
-            target = self._target_size * 1024 * 1024
-            sys.stdout.write(
-                f"\r{self._total_transferred} of {target} transferred "
-                f"({(self._total_transferred / target) * 100:.2f}%).")
-            sys.stdout.flush()
+def file_etag(path, part_size=None):
+    """ETag S3 gives a file: md5 of the content, or of the part md5s for a multipart upload"""
+    with open(path, "rb") as f:
+        if part_size is None:
+            digest = hashlib.md5()
+            for chunk in iter(lambda: f.read(MB), b""):
+                digest.update(chunk)
+            return '"{0}"'.format(digest.hexdigest())
+        parts = [hashlib.md5(part).digest() for part in iter(lambda: f.read(part_size), b"")]
+    return '"{0}-{1}"'.format(hashlib.md5(b"".join(parts)).hexdigest(), len(parts))
 
 
 class S3Handler:
-    def __init__(self, location):
-        self.s3: ServiceResource = boto3.resource('s3')
+    def __init__(self, location, profile: TransferProfile = None):
+        self.s3: ServiceResource = AWSBackend().get_resource('s3', region=None)
         self.location = location
+        self.profile = profile or TransferProfile.current()
         self.logger = logging.getLogger(S3Handler.__class__.__name__)
 
     def create_bucket(self, name):
@@ -157,39 +159,63 @@ class S3Handler:
             self.logger.exception("Couldn't delete policy for bucket '%s'.", bucket_name)
             raise
 
+    def _upload(self, local_file_path, bucket_name, object_key, extra_args):
+        size = os.path.getsize(local_file_path)
+        meter = TransferMeter(size)
+        tuner = self.profile.tuner("upload")
+        started = time.monotonic()
+        if size >= self.profile.threshold:
+            # our own multipart upload: it resumes after a failure and the tuner can steer it
+            ResumableUpload(self.s3.meta.client, bucket_name, object_key, local_file_path, extra_args,
+                            part_size=tuner.part_size if tuner else self.profile.part_size,
+                            concurrency=self.profile.concurrency, tuner=tuner, meter=meter).run()
+            return meter.finish()
+        self.s3.Bucket(bucket_name).upload_file(
+            local_file_path,
+            object_key,
+            ExtraArgs=extra_args,
+            Callback=meter,
+            Config=self.profile.config(tuner))
+        record_throughput("upload", size, time.monotonic() - started)
+        if tuner:
+            tuner.observe_transfer(size, time.monotonic() - started)
+            tuner.save()
+        return meter.finish()
+
     def upload_public(self, local_file_path, bucket_name, object_key,
                       file_size_mb):
-        s3 = self.s3
         extra_args = {
             "ACL": "public-read"
         }
-
-        tcb = TransferProgress(file_size_mb)
-        s3.Bucket(bucket_name).upload_file(
-            local_file_path,
-            object_key,
-            ExtraArgs=extra_args,
-            Callback=tcb)
-        return tcb.thread_info
+        return self._upload(local_file_path, bucket_name, object_key, extra_args)
 
     def upload_bucket_private(self, local_file_path, bucket_name, object_key, file_size_mb):
-        s3 = self.s3
         extra_args = {
             "ACL": "bucket-owner-full-control"
         }
-        tcb = TransferProgress(file_size_mb)
-        s3.Bucket(bucket_name).upload_file(
-            local_file_path,
-            object_key,
-            ExtraArgs=extra_args,
-            Callback=tcb
-        )
+        return self._upload(local_file_path, bucket_name, object_key, extra_args)
 
-        return tcb.thread_info
+    def open_multipart(self, bucket_name, object_key, part_size=None, concurrency=None, extra_args=None,
+                       tuner=None, meter=None):
+        """Writable stream that lands in the bucket privately as a multipart upload"""
+        if extra_args is None:
+            extra_args = {
+                "ACL": "bucket-owner-full-control"
+            }
+        return MultipartWriter(self.s3.meta.client, bucket_name, object_key, extra_args,
+                               part_size=part_size or self.profile.part_size,
+                               concurrency=concurrency or self.profile.concurrency,
+                               tuner=tuner or self.profile.tuner("upload"),
+                               meter=meter)
+
+    def upload_stream(self, stream, bucket_name, object_key, part_size=None, concurrency=None):
+        with self.open_multipart(bucket_name, object_key, part_size, concurrency) as writer:
+            for chunk in iter(lambda: stream.read(MB), b""):
+                writer.write(chunk)
+        return writer.size
 
     def upload_file(self, local_file_path, bucket_name, object_key,
                     file_size_mb, sse_key=None, metadata=None):
-        s3 = self.s3
         extra_args = {}
         if sse_key:
             extra_args['SSECustomerAlgorithm'] = 'AES256'
@@ -201,22 +227,13 @@ class S3Handler:
         if not extra_args:
             extra_args = None
 
-        tcb = TransferProgress(file_size_mb)
-        s3.Bucket(bucket_name).upload_file(
-            local_file_path,
-            object_key,
-            ExtraArgs=extra_args,
-            Callback=tcb)
-
-        return tcb.thread_info
+        return self._upload(local_file_path, bucket_name, object_key, extra_args)
 
     def download_file(self, bucket_name, object_key, target_path,
                       file_size_mb=None, sse_key=None):
         s3 = self.s3
-        if file_size_mb:
-            tcb = TransferProgress(file_size_mb)
-        else:
-            tcb = None
+        # without a size there is nothing to show progress against, the stats are still kept
+        meter = TransferMeter(file_size_mb * MB) if file_size_mb else TransferMeter(out=None)
 
         if sse_key:
             extra_args = {
@@ -225,10 +242,233 @@ class S3Handler:
         else:
             extra_args = None
 
+        tuner = self.profile.tuner("download")
+        started = time.monotonic()
+        head = s3.meta.client.head_object(Bucket=bucket_name, Key=object_key, **(extra_args or {}))
+        if head['ContentLength'] >= self.profile.threshold:
+            # ranged and checkpointed, a re-run continues where this one stopped
+            RangedDownload(s3.meta.client, bucket_name, object_key, target_path, extra_args,
+                           part_size=tuner.part_size if tuner else self.profile.part_size,
+                           concurrency=tuner.concurrency if tuner else self.profile.concurrency,
+                           meter=meter).run(head['ContentLength'], head['ETag'])
+            if tuner:
+                tuner.observe_transfer(head['ContentLength'], time.monotonic() - started)
+                tuner.save()
+            return meter.finish()
         s3.Bucket(bucket_name).Object(object_key).download_file(
             target_path,
             ExtraArgs=extra_args,
-            Callback=tcb)
+            Callback=meter,
+            Config=self.profile.config(tuner))
+        record_throughput("download", os.path.getsize(target_path), time.monotonic() - started)
+        if tuner:
+            tuner.observe_transfer(os.path.getsize(target_path), time.monotonic() - started)
+            tuner.save()
+        return meter.finish()
+
+    def object_exists(self, bucket_name, object_key):
+        try:
+            self.s3.meta.client.head_object(Bucket=bucket_name, Key=object_key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "403", "NoSuchKey"):
+                return False
+            raise error
+        return True
+
+    def wait_for_object(self, bucket_name, object_key, timeout, interval=0.25, max_interval=4, wake=None):
+        """HEAD polling with exponential backoff until the object exists or timeout passes.
+
+        wake(seconds), if given, replaces the sleeps: it blocks until an event announces the
+        object (True) or seconds pass (False), polling then only guards against lost events.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.object_exists(bucket_name, object_key):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if wake is not None:
+                if wake(remaining):
+                    return True
+            else:
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, max_interval)
+        return True
+
+    def open_object(self, bucket_name, object_key):
+        """Streaming body of the object, read it as it arrives and close it to stop early"""
+        return self.s3.meta.client.get_object(Bucket=bucket_name, Key=object_key)['Body']
+
+    def read_object(self, bucket_name, object_key):
+        return self.s3.meta.client.get_object(Bucket=bucket_name, Key=object_key)['Body'].read()
+
+    def write_object(self, bucket_name, object_key, data):
+        """Small objects in a single PUT, without the transfer manager"""
+        self.s3.meta.client.put_object(Bucket=bucket_name, Key=object_key, Body=data,
+                                       ACL="bucket-owner-full-control")
+
+    def put_if(self, bucket_name, object_key, data, etag=None):
+        """PUT only if the object does not exist, or with etag only if it still has that ETag.
+
+        False when the condition failed, someone else wrote the object first.
+        """
+        condition = {"IfNoneMatch": "*"} if etag is None else {"IfMatch": etag}
+        try:
+            self.s3.meta.client.put_object(Bucket=bucket_name, Key=object_key, Body=data,
+                                           ACL="bucket-owner-full-control", **condition)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict", "412", "409"):
+                return False
+            raise error
+        return True
+
+    def read_tagged(self, bucket_name, object_key):
+        """(data, ETag) of an object, (None, None) if there is none"""
+        try:
+            response = self.s3.meta.client.get_object(Bucket=bucket_name, Key=object_key)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None, None
+            raise error
+        return response['Body'].read(), response['ETag']
+
+    def get_range(self, bucket_name, object_key, offset, length):
+        """length bytes starting at offset, with a single HTTP Range request"""
+        response = self.s3.meta.client.get_object(Bucket=bucket_name,
+                                                  Key=object_key,
+                                                  Range="bytes={0}-{1}".format(offset, offset + length - 1))
+        return response['Body'].read()
+
+    def missing_keys(self, bucket_name, object_keys, workers=16):
+        """HEAD every key concurrently and return the ones the bucket does not have"""
+        object_keys = list(object_keys)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            found = pool.map(lambda key: self.object_exists(bucket_name, key), object_keys)
+            return [key for key, exists in zip(object_keys, found) if not exists]
+
+    def upload_many(self, bucket_name, files, workers=8):
+        """Upload a {object_key: local_path} mapping privately with a bounded thread pool"""
+        client = self.s3.meta.client
+        # the files themselves are transferred in parallel already, keep each one to a few streams
+        config = TransferProfile(self.profile.threshold, self.profile.part_size, 2).config()
+        extra_args = {
+            "ACL": "bucket-owner-full-control"
+        }
 
-        if tcb:
-            return tcb.thread_info
+        def upload(item):
+            object_key, local_file_path = item
+            client.upload_file(local_file_path, bucket_name, object_key, ExtraArgs=extra_args, Config=config)
+            self.logger.debug("Uploaded %s to %s", local_file_path, object_key)
+            return object_key
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(upload, files.items()))
+
+    def download_many(self, bucket_name, files, workers=8):
+        """Download a {object_key: local_path} mapping with a bounded thread pool"""
+        client = self.s3.meta.client
+        config = TransferProfile(self.profile.threshold, self.profile.part_size, 2).config()
+
+        def download(item):
+            object_key, target_path = item
+            os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
+            client.download_file(bucket_name, object_key, target_path, Config=config)
+            return target_path
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(download, files.items()))
+
+    def list_objects(self, bucket_name, prefix=""):
+        """{object_key: {"size", "etag", "modified"}} of everything under prefix, page by page"""
+        objects = {}
+        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for content in page.get('Contents', []):
+                objects[content['Key']] = {"size": content['Size'], "etag": content['ETag'],
+                                           "modified": content['LastModified'].timestamp()}
+        return objects
+
+    def touch_object(self, bucket_name, object_key):
+        """Bumps LastModified by copying the object onto itself, with its ACL, content headers and metadata"""
+        head = self.s3.meta.client.head_object(Bucket=bucket_name, Key=object_key)
+        # a copy onto itself must replace something, the same values it is
+        headers = {name: head[name] for name in ("ContentType", "ContentEncoding", "ContentDisposition",
+                                                  "ContentLanguage", "CacheControl") if name in head}
+        self.s3.meta.client.copy_object(Bucket=bucket_name, Key=object_key,
+                                        CopySource={"Bucket": bucket_name, "Key": object_key},
+                                        MetadataDirective="REPLACE", Metadata=head.get("Metadata", {}),
+                                        ACL="bucket-owner-full-control", **headers)
+
+    def delete_objects(self, bucket_name, object_keys):
+        object_keys = list(object_keys)
+        for i in range(0, len(object_keys), 1000):
+            self.s3.meta.client.delete_objects(Bucket=bucket_name, Delete={
+                "Objects": [{"Key": object_key} for object_key in object_keys[i:i + 1000]], "Quiet": True})
+
+    def same_content(self, local_file_path, remote):
+        """Compares a local file with a list_objects entry, by size first and then by ETag.
+
+        Multipart ETags depend on the part size, the usual ones are tried. Objects whose ETag
+        is not an md5 (SSE-KMS) never compare equal and are transferred again.
+        """
+        size = os.path.getsize(local_file_path)
+        if size != remote["size"]:
+            return False
+        etag = remote["etag"]
+        if "-" not in etag:
+            return file_etag(local_file_path) == etag
+        parts = int(etag.strip('"').split("-")[1])
+        guess = -(-size // parts)
+        candidates = {self.profile.part_size, 8 * MB, 16 * MB, 64 * MB, guess, guess + (-guess) % MB}
+        for part_size in sorted(candidates):
+            if -(-size // part_size) == parts and file_etag(local_file_path, part_size) == etag:
+                return True
+        return False
+
+    def _differing(self, pairs, remote, workers):
+        """(object_key, local_path) pairs whose content is not on both sides already"""
+        def differs(pair):
+            object_key, local_file_path = pair
+            return object_key not in remote or not os.path.exists(local_file_path) \
+                or not self.same_content(local_file_path, remote[object_key])
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return [pair for pair, changed in zip(pairs, pool.map(differs, pairs)) if changed]
+
+    def sync_up(self, folder, bucket_name, prefix, workers=8):
+        """Uploads the files of folder under prefix, skipping the ones the bucket already holds"""
+        prefix = prefix.strip("/")
+        pairs = []
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                local_file_path = os.path.join(root, name)
+                relative = os.path.relpath(local_file_path, folder).replace(os.path.sep, "/")
+                pairs.append((posixpath.join(prefix, relative) if prefix else relative, local_file_path))
+        remote = self.list_objects(bucket_name, prefix + "/" if prefix else "")
+        changed = self._differing(pairs, remote, workers)
+        return self.upload_many(bucket_name, dict(changed), workers)
+
+    def sync_down(self, bucket_name, prefix, folder, workers=8):
+        """Downloads the objects under prefix into folder, skipping the files that are up to date"""
+        root = os.path.realpath(folder)
+        # a prefix names a folder, "data" must not pick up "data2/..."
+        prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        remote = self.list_objects(bucket_name, prefix)
+        pairs = []
+        for object_key in remote:
+            if object_key.endswith("/"):
+                continue  # folder placeholders of the console
+            relative = object_key[len(prefix):]
+            target_path = os.path.realpath(os.path.join(root, *relative.split("/")))
+            if os.path.commonpath([root, target_path]) != root:
+                raise RuntimeError("Object {0} escapes the target folder".format(object_key))
+            pairs.append((object_key, target_path))
+        changed = self._differing(pairs, remote, workers)
+        self.download_many(bucket_name, dict(changed), workers)
+        return [object_key for object_key, _ in changed]
+
+    def clean_orphans(self, bucket_name, prefix=None, max_age=Checkpoint.MAX_AGE):
+        """Aborts the multipart uploads of stale local checkpoints, and under prefix those nobody is going to resume"""
+        aborted = clean_orphans(self.s3.meta.client, bucket_name, prefix, max_age)
+        for object_key in aborted:
+            self.logger.info("Aborted orphaned multipart upload of %s", object_key)
+        return aborted
@@ -1,12 +1,24 @@
+from __future__ import annotations
+
+import functools
 import json
 import logging
-import boto3
-from boto3_type_annotations.sns import ServiceResource, Topic, Subscription
+import os
+import threading
+import time
+from typing import TYPE_CHECKING
+
 from botocore.exceptions import ClientError
 
+from aws.aws_backend import AWSBackend
+from utils.store import state_dir, load_json, save_json
+
+if TYPE_CHECKING:
+    from boto3_type_annotations.sns import ServiceResource, Topic, Subscription
 
-def sns_resource():
-    sns: ServiceResource = boto3.resource('sns')
+
+def sns_resource(location=None):
+    sns: ServiceResource = AWSBackend().get_resource('sns', region=location)
     return sns
 
 
@@ -14,6 +26,97 @@ def sns_logger():
     return logging.getLogger("SNS_LOGGER")
 
 
+TOPICS_FILE = "topics.json"
+TOPICS_TTL = 3600
+
+
+@functools.lru_cache(maxsize=None)
+def _account(profile, region):
+    """Id of the account the credentials of profile belong to"""
+    return AWSBackend().get_client('sts', profile=profile, region=region).get_caller_identity()['Account']
+
+
+class TopicIndex:
+    """Topic name -> ARN of an account's region, the name being the last part of the ARN.
+
+    The cache is kept per account, profile and region, so switching credentials never hands
+    out the topics of another account. Built with one paginated ListTopics walk (no attribute reads) and kept in memory and in
+    ~/.awsrun for ttl seconds, so resolving a topic costs no API call most of the time.
+    create_topic and delete_topic keep it current, topics changed elsewhere show once it expires.
+    """
+    _indexes = {}
+    _indexes_lock = threading.Lock()
+
+    def __init__(self, region, account, profile=None, ttl=TOPICS_TTL, path=None):
+        self._region = region
+        self._key = "{}:{}:{}".format(account, profile or "default", region)
+        self._ttl = ttl
+        self._path = path or os.path.join(state_dir(), TOPICS_FILE)
+        self._lock = threading.Lock()
+        self._topics = None
+        self._built = 0
+
+    @staticmethod
+    def of(region, profile=None):
+        """The index of region for the credentials of profile (AWS_PROFILE or the default ones)"""
+        profile = profile or os.environ.get("AWS_PROFILE")
+        key = (_account(profile, region), profile, region)
+        with TopicIndex._indexes_lock:
+            if key not in TopicIndex._indexes:
+                TopicIndex._indexes[key] = TopicIndex(region, *key[:2])
+            return TopicIndex._indexes[key]
+
+    def _fresh(self):
+        """whether the index is recent enough, read from disk if the memory copy is not; the lock is held"""
+        if self._topics is not None and time.time() - self._built < self._ttl:
+            return True
+        cached = load_json(self._path, {}).get(self._key)
+        if cached and time.time() - cached["built"] < self._ttl:
+            self._topics, self._built = cached["topics"], cached["built"]
+            return True
+        return False
+
+    def _save(self):
+        state = load_json(self._path, {})
+        state[self._key] = {"built": self._built, "topics": self._topics}
+        save_json(self._path, state)
+
+    def rebuild(self):
+        paginator = sns_resource(self._region).meta.client.get_paginator('list_topics')
+        topics = {}
+        for page in paginator.paginate():
+            for topic in page['Topics']:
+                topics[topic['TopicArn'].split(':')[-1]] = topic['TopicArn']
+        with self._lock:
+            self._topics, self._built = topics, time.time()
+            self._save()
+
+    def arn(self, name):
+        """ARN of the topic named name, None if there is none"""
+        with self._lock:
+            fresh = self._fresh()
+        if not fresh:
+            self.rebuild()
+        with self._lock:
+            return self._topics.get(name)
+
+    def add(self, arn):
+        with self._lock:
+            if self._fresh():
+                self._topics[arn.split(':')[-1]] = arn
+                self._save()
+
+    def remove(self, arn):
+        with self._lock:
+            if self._fresh():
+                self._topics.pop(arn.split(':')[-1], None)
+                self._save()
+
+
+def _topic_index():
+    return TopicIndex.of(sns_resource().meta.client.meta.region_name)
+
+
 def create_topic(name):
     try:
         topic: Topic = sns_resource().create_topic(Name=name)
@@ -22,6 +125,7 @@ def create_topic(name):
         sns_logger().exception("Couldn't create topic %s.", name)
         raise
     else:
+        _topic_index().add(topic.arn)
         return topic
 
 
@@ -36,11 +140,15 @@ def list_topics():
         return topics_iter
 
 
+def get_topic(name):
+    """The topic named name through the TopicIndex, None if there is none"""
+    arn = _topic_index().arn(name)
+    return None if arn is None else sns_resource().Topic(arn)
+
+
 def create_or_get_topic(name):
-    for topic in list_topics():
-        if topic.attributes['DisplayName'] == name:
-            return topic
-    return create_topic(name)
+    # CreateTopic returns the existing topic of that name, a stale miss costs no duplicate
+    return get_topic(name) or create_topic(name)
 
 
 def delete_topic(topic):
@@ -50,6 +158,8 @@ def delete_topic(topic):
     except ClientError:
         sns_logger().exception("Couldn't delete topic %s.", topic.arn)
         raise
+    else:
+        _topic_index().remove(topic.arn)
 
 
 def subscribe(topic, protocol, endpoint):
@@ -100,19 +210,6 @@ def delete_subscription(subscription: Subscription):
         raise
 
 
-@staticmethod
-def add_subscription_filter(subscription, attributes):
-    try:
-        att_policy = {key: [value] for key, value in attributes.items()}
-        subscription.set_attributes(
-            AttributeName='FilterPolicy', AttributeValue=json.dumps(att_policy))
-        sns_logger().info("Added filter to subscription %s.", subscription.arn)
-    except ClientError:
-        sns_logger().exception(
-            "Couldn't add filter to subscription %s.", subscription.arn)
-        raise
-
-
 def publish_message(topic: Topic, message, attributes={}):
     try:
         att_dict = {}
@@ -1,16 +1,89 @@
+from __future__ import annotations
+
+import gzip
+import json
 import logging
-import boto3
+import uuid
+from typing import TYPE_CHECKING
 
-from boto3_type_annotations.sqs import ServiceResource, Client, Queue
 from botocore.exceptions import ClientError
 
+from aws.aws_backend import AWSBackend
+from aws.aws_s3 import S3Handler
+
+if TYPE_CHECKING:
+    from boto3_type_annotations.sqs import ServiceResource, Client, Queue
+
+
+CLAIM_ATTRIBUTE = "awsrun-claim"
+
+
+class ClaimCheck:
+    """Parks message bodies over threshold bytes gzip'ed in S3, the queue only carries a reference.
+
+    The reference names its bucket and key, so receivers need no setup: SqsHandler.body
+    fetches the parked body when it is asked for. Parked bodies are not deleted with their
+    message, a standard queue may deliver it again afterwards; the bucket needs a lifecycle rule
+    expiring prefix (messages/) after more than the queues' retention period, e.g. 15 days.
+    """
+    THRESHOLD = 64 * 1024
+    PREFIX = "messages/"
+
+    def __init__(self, location, bucket_name, threshold=THRESHOLD, prefix=PREFIX):
+        self._s3 = S3Handler(location)
+        self._bucket = bucket_name
+        self._threshold = threshold
+        self._prefix = prefix
+
+    def check(self, body, attributes):
+        """(body, attributes) to enqueue, a claim instead of the body when the body is too large"""
+        data = body.encode()
+        if len(data) <= self._threshold:
+            return body, attributes
+        key = self._prefix + uuid.uuid4().hex + ".json.gz"
+        self._s3.write_object(self._bucket, key, gzip.compress(data))
+        attributes = dict(attributes)
+        attributes[CLAIM_ATTRIBUTE] = {"DataType": "String", "StringValue": "gzip"}
+        return json.dumps({"bucket": self._bucket, "key": key, "size": len(data)}), attributes
+
+    @staticmethod
+    def claimed(message):
+        return CLAIM_ATTRIBUTE in (message.message_attributes or {})
+
 
 class SqsHandler:
-    def __init__(self, location):
-        self.sqs: ServiceResource = boto3.resource('sqs', region_name=location)
+    # SendMessageBatch limits
+    MAX_BATCH = 10
+    MAX_BATCH_BYTES = 256 * 1024
+    FIFO = ".fifo"
+
+    def __init__(self, location, claims: ClaimCheck = None):
+        self.sqs: ServiceResource = AWSBackend().get_resource('sqs', region=location)
         self.logger = logging.getLogger(SqsHandler.__class__.__name__)
+        self._location = location
+        self._claims = claims
+
+    @staticmethod
+    def is_fifo(queue):
+        return queue.url.endswith(SqsHandler.FIFO)
+
+    @staticmethod
+    def fifo_args(queue, group=None, dedup=None):
+        """MessageGroupId and MessageDeduplicationId on a FIFO queue, nothing on a standard one"""
+        if not SqsHandler.is_fifo(queue):
+            return {}
+        args = {'MessageGroupId': group or 'default'}
+        if dedup:
+            args['MessageDeduplicationId'] = dedup
+        return args
 
-    def create_queue(self, name, attributes={}):
+    def create_queue(self, name, attributes={}, fifo=False):
+        """A FIFO queue deduplicates by the ids the tasks bring and by body for other messages, per message
+        group and with the high throughput limits"""
+        if fifo:
+            name = name if name.endswith(SqsHandler.FIFO) else name + SqsHandler.FIFO
+            attributes = dict(attributes, FifoQueue='true', ContentBasedDeduplication='true',
+                              DeduplicationScope='messageGroup', FifoThroughputLimit='perMessageGroupId')
         try:
             queue: Queue = self.sqs.create_queue(
                 QueueName=name,
@@ -71,11 +144,13 @@ class SqsHandler:
             self.logger.exception("Couldn't delete queue with URL=%s!", queue.url)
             raise error
 
-    def send_message(self, queue, message_body, message_attributes={}):
+    def send_message(self, queue, message_body, message_attributes={}, group=None, dedup=None):
+        message_body, message_attributes = self.prepare(message_body, message_attributes)
         try:
             response = queue.send_message(
                 MessageBody=message_body,
-                MessageAttributes=message_attributes
+                MessageAttributes=message_attributes,
+                **self.fifo_args(queue, group, dedup)
             )
         except ClientError as error:
             self.logger.exception("Send message failed: %s", message_body)
@@ -83,49 +158,90 @@ class SqsHandler:
         else:
             return response
 
-    def send_messages(self, queue, messages):
+    def prepare(self, message_body, message_attributes):
+        """(body, attributes) as they go on the queue, with large bodies parked in S3"""
+        if self._claims:
+            return self._claims.check(message_body, message_attributes)
+        return message_body, message_attributes
+
+    @staticmethod
+    def entry_size(entry):
+        """Bytes an entry counts for against the batch limit, attributes included"""
+        size = len(entry['MessageBody'].encode())
+        for name, value in entry.get('MessageAttributes', {}).items():
+            size += len(name.encode()) + len(value['DataType'].encode()) + len(value.get('StringValue', '').encode()) \
+                    + len(value.get('BinaryValue', b''))
+        return size
+
+    @staticmethod
+    def batches(items, entry=lambda item: item):
+        """Splits items into groups that fit one SendMessageBatch, entry(item) is the entry of an item"""
+        batch, size = [], 0
+        for item in items:
+            length = SqsHandler.entry_size(entry(item))
+            if batch and (len(batch) == SqsHandler.MAX_BATCH or size + length > SqsHandler.MAX_BATCH_BYTES):
+                yield batch
+                batch, size = [], 0
+            batch.append(item)
+            size += length
+        if batch:
+            yield batch
+
+    def send_batch(self, queue, entries):
+        """One SendMessageBatch of entries that already fit it"""
         try:
-            entries = [{
-                'Id': str(ind),
-                'MessageBody': msg['body'],
-                'MessageAttributes': msg['attributes']
-            } for ind, msg in enumerate(messages)]
             response = queue.send_messages(Entries=entries)
-            if 'Successful' in response:
-                for msg_meta in response['Successful']:
-                    self.logger.info(
-                        "Message sent: %s: %s",
-                        msg_meta['MessageId'],
-                        messages[int(msg_meta['Id'])]['body']
-                    )
-            if 'Failed' in response:
-                for msg_meta in response['Failed']:
-                    self.logger.warning(
-                        "Failed to send: %s: %s",
-                        msg_meta['MessageId'],
-                        messages[int(msg_meta['Id'])]['body']
-                    )
         except ClientError as error:
             self.logger.exception("Send messages failed to queue: %s", queue)
             raise error
-        else:
-            return response
+        for msg_meta in response.get('Successful', []):
+            self.logger.debug("Message sent: %s", msg_meta['MessageId'])
+        for msg_meta in response.get('Failed', []):
+            self.logger.warning("Failed to send: %s: %s", msg_meta['Code'], msg_meta.get('Message', ''))
+        return response
+
+    def send_messages(self, queue, messages):
+        """Sends [{'body', 'attributes'[, 'group', 'dedup']}] in as many batches as the SQS limits need, Ids are
+        list positions"""
+        entries = []
+        for ind, msg in enumerate(messages):
+            body, attributes = self.prepare(msg['body'], msg['attributes'])
+            entries.append(dict({'Id': str(ind), 'MessageBody': body, 'MessageAttributes': attributes},
+                                **self.fifo_args(queue, msg.get('group'), msg.get('dedup'))))
+        response = {'Successful': [], 'Failed': []}
+        for batch in self.batches(entries):
+            sent = self.send_batch(queue, batch)
+            response['Successful'].extend(sent.get('Successful', []))
+            response['Failed'].extend(sent.get('Failed', []))
+        return response
 
-    def receive_messages(self, queue, max_number, wait_time=None):
+    def receive_messages(self, queue, max_number, wait_time=None, visibility_timeout=None, attribute_names=None):
+        """attribute_names: SQS system attributes to receive too, like 'SenderId'"""
+        extra_args = {} if visibility_timeout is None else {'VisibilityTimeout': visibility_timeout}
+        if attribute_names:
+            extra_args['AttributeNames'] = attribute_names
         try:
             messages = queue.receive_messages(
                 MessageAttributeNames=['All'],
                 MaxNumberOfMessages=max_number,
-                WaitTimeSeconds=wait_time
+                WaitTimeSeconds=wait_time,
+                **extra_args
             )
             for msg in messages:
-                self.logger.info("Received message: %s: %s", msg.message_id, msg.body)
+                self.logger.debug("Received message: %s: %s", msg.message_id, msg.body)
         except ClientError as error:
             self.logger.exception("Couldn't receive messages from queue: %s", queue)
             raise error
         else:
             return messages
 
+    def body(self, message):
+        """Body of a received message, fetched from S3 if it was parked there"""
+        if not ClaimCheck.claimed(message):
+            return message.body
+        claim = json.loads(message.body)
+        return gzip.decompress(S3Handler(self._location).read_object(claim['bucket'], claim['key'])).decode()
+
     def delete_message(self, message):
         try:
             message.delete()
@@ -155,6 +271,29 @@ class SqsHandler:
         else:
             return response
 
+    def change_visibility(self, queue, messages, timeout):
+        """Sets the visibility timeout of up to 10 received messages, returns the failed ones"""
+        entries = [{
+            'Id': str(ind),
+            'ReceiptHandle': msg.receipt_handle,
+            'VisibilityTimeout': timeout
+        } for ind, msg in enumerate(messages)]
+        try:
+            response = queue.change_message_visibility_batch(Entries=entries)
+        except ClientError as error:
+            self.logger.exception("Couldn't change the visibility of messages in queue %s", queue)
+            raise error
+        return [messages[int(msg_meta['Id'])] for msg_meta in response.get('Failed', [])]
+
+    @staticmethod
+    def get_queue_depth(queue: Queue):
+        """(waiting, in flight) messages right now, queue.attributes only holds what was loaded last"""
+        attributes = queue.meta.client.get_queue_attributes(
+            QueueUrl=queue.url,
+            AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible']
+        )['Attributes']
+        return int(attributes['ApproximateNumberOfMessages']), int(attributes['ApproximateNumberOfMessagesNotVisible'])
+
     @staticmethod
     def get_message_cnt(queue: Queue):
         return int(queue.attributes['ApproximateNumberOfMessages'])
@@ -1,14 +1,20 @@
+from __future__ import annotations
+
 import logging
 import time
+from typing import TYPE_CHECKING
 
-import boto3
-from boto3_type_annotations.ssm import Client
 from botocore.exceptions import ClientError
 
+from aws.aws_backend import AWSBackend
+
+if TYPE_CHECKING:
+    from boto3_type_annotations.ssm import Client
+
 
 class SSMHandler:
     def __init__(self, timeout=30):
-        self._ssm_client: Client = boto3.client('ssm')
+        self._ssm_client: Client = AWSBackend().get_client('ssm', region=None)
         self._timeout = timeout
         self._logger = logging.getLogger(SSMHandler.__class__.__name__)
 
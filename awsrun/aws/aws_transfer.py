@@ -0,0 +1,447 @@
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.store import state_dir, load_json, save_json
+
+MB = 1024 * 1024
+THROUGHPUT_FILE = "throughput.json"
+TUNING_FILE = "tuning.json"
+
+
+def record_throughput(direction, nbytes, seconds, weight=0.3):
+    """Fold a finished transfer into the persisted moving average for 'upload'/'download'"""
+    if seconds <= 0 or nbytes < MB:
+        return  # tiny transfers measure latency, not bandwidth
+    rate = nbytes / seconds
+    try:
+        path = os.path.join(state_dir(), THROUGHPUT_FILE)
+        rates = load_json(path, {})
+        rates[direction] = rate if direction not in rates else (1 - weight) * rates[direction] + weight * rate
+        save_json(path, rates)
+    except OSError:
+        pass  # best effort, a read-only home only costs us the estimate
+
+
+def measured_throughput(direction, default=2 * MB):
+    try:
+        return load_json(os.path.join(state_dir(), THROUGHPUT_FILE), {}).get(direction, default)
+    except OSError:
+        return default
+
+
+def network_id():
+    """Local address used to reach the internet, tells the lab network from the home one"""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.connect(("192.0.2.1", 9))  # nothing is sent for a udp connect
+            return probe.getsockname()[0]
+    except OSError:
+        return "default"
+
+
+class TransferProfile:
+    """Multipart threshold, part size and concurrency of S3 transfers.
+
+    An adaptive profile only gives the starting point, TransferTuner moves it while
+    transfers run and remembers where it ended up per network.
+    """
+    PRESETS = {
+        # boto3's own defaults
+        "default": dict(threshold=8 * MB, part_size=8 * MB, concurrency=10),
+        "fast": dict(threshold=64 * MB, part_size=64 * MB, concurrency=16),
+        "slow": dict(threshold=16 * MB, part_size=8 * MB, concurrency=2),
+        "adaptive": dict(threshold=8 * MB, part_size=8 * MB, concurrency=4, adaptive=True)
+    }
+    _current = None
+
+    def __init__(self, threshold=8 * MB, part_size=8 * MB, concurrency=10, adaptive=False):
+        self.threshold = threshold
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+
+    @staticmethod
+    def named(name):
+        if name not in TransferProfile.PRESETS:
+            raise RuntimeError("Unknown transfer profile {0}".format(name))
+        return TransferProfile(**TransferProfile.PRESETS[name])
+
+    @staticmethod
+    def use(name):
+        """Profile of the S3Handlers created from now on"""
+        TransferProfile._current = TransferProfile.named(name)
+        return TransferProfile._current
+
+    @staticmethod
+    def current():
+        if TransferProfile._current is None:
+            TransferProfile._current = TransferProfile.named(os.environ.get("AWSRUN_TRANSFER_PROFILE", "default"))
+        return TransferProfile._current
+
+    def tuner(self, direction):
+        return TransferTuner(direction, self) if self.adaptive else None
+
+    def config(self, tuner=None):
+        from boto3.s3.transfer import TransferConfig  # s3transfer is slow to import, only boto3 transfers need it
+        part_size = tuner.part_size if tuner else self.part_size
+        concurrency = tuner.concurrency if tuner else self.concurrency
+        return TransferConfig(multipart_threshold=self.threshold, multipart_chunksize=part_size,
+                              max_concurrency=concurrency)
+
+
+class TransferTuner:
+    """Hill climbing on the concurrency of one transfer direction, with parts sized by the speed of a stream.
+
+    Every finished part is reported to observe(). Once per window (as many parts as there are
+    streams) the aggregate rate is compared with the previous window: an improvement keeps
+    the concurrency moving in the same direction, a loss turns it around. Parts are sized to
+    take about PART_SECONDS on one stream, so slow links get small parts (cheap retries, more
+    parallelism) and fast ones large parts (fewer requests). save() keeps the result per network.
+    """
+    MIN_PART_SIZE = 5 * MB
+    MAX_PART_SIZE = 256 * MB
+    MAX_CONCURRENCY = 32
+    PART_SECONDS = 4
+    GAIN = 1.05
+
+    def __init__(self, direction, profile: TransferProfile):
+        self._direction = direction
+        self._path = os.path.join(state_dir(), TUNING_FILE)
+        self._network = network_id()
+        learned = load_json(self._path, {}).get(self._network, {}).get(direction, {})
+        self.part_size = learned.get("part_size", profile.part_size)
+        self.concurrency = learned.get("concurrency", profile.concurrency)
+        self._lock = threading.Lock()
+        self._stream_rate = learned.get("stream_rate")
+        self._transfer_rate = learned.get("transfer_rate")
+        self._previous = None
+        self._step = learned.get("step", 1)
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._window_parts = 0
+
+    def observe(self, nbytes, seconds):
+        """A part of nbytes took seconds on one stream"""
+        if seconds <= 0:
+            return
+        with self._lock:
+            rate = nbytes / seconds
+            self._stream_rate = rate if self._stream_rate is None else 0.7 * self._stream_rate + 0.3 * rate
+            self._window_bytes += nbytes
+            self._window_parts += 1
+            if self._window_parts < self.concurrency:
+                return
+            window_rate = self._window_bytes / max(time.monotonic() - self._window_start, 1e-6)
+            if self._previous is not None and window_rate < self._previous * TransferTuner.GAIN:
+                # no gain from the last move, try the other way
+                self._step = -self._step
+            self._previous = window_rate
+            self.concurrency = min(max(self.concurrency + self._step, 1), TransferTuner.MAX_CONCURRENCY)
+            self.part_size = self._sized(self._stream_rate * TransferTuner.PART_SECONDS)
+            self._reset_window()
+
+    def observe_transfer(self, nbytes, seconds):
+        """Whole transfer done by boto3, the climb then moves one step per transfer instead of per window"""
+        if seconds <= 0 or nbytes < self.part_size:
+            return
+        with self._lock:
+            rate = nbytes / seconds
+            if self._transfer_rate is not None and rate < self._transfer_rate * TransferTuner.GAIN:
+                self._step = -self._step
+            self._transfer_rate = rate
+            # per stream rate, as if the streams shared the bandwidth evenly
+            self._stream_rate = rate / self.concurrency
+            self.concurrency = min(max(self.concurrency + self._step, 1), TransferTuner.MAX_CONCURRENCY)
+            self.part_size = self._sized(self._stream_rate * TransferTuner.PART_SECONDS)
+
+    @staticmethod
+    def _sized(nbytes):
+        nbytes = min(max(int(nbytes), TransferTuner.MIN_PART_SIZE), TransferTuner.MAX_PART_SIZE)
+        return nbytes - nbytes % MB
+
+    def save(self):
+        try:
+            content = load_json(self._path, {})
+            content.setdefault(self._network, {})[self._direction] = {
+                "part_size": self.part_size,
+                "concurrency": self.concurrency,
+                "stream_rate": self._stream_rate,
+                "transfer_rate": self._transfer_rate,
+                "step": self._step
+            }
+            save_json(self._path, content)
+        except OSError:
+            pass  # best effort like the throughput estimate
+
+
+class TransferStats:
+    """Machine readable outcome of a transfer: bytes, time, bytes per thread and part latencies"""
+
+    def __init__(self, nbytes, seconds, threads, latencies):
+        self.bytes = nbytes
+        self.seconds = seconds
+        self.threads = threads
+        self.latencies = sorted(latencies)
+
+    @property
+    def throughput(self):
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    def percentile(self, q):
+        if not self.latencies:
+            return None
+        return self.latencies[min(int(q / 100 * len(self.latencies)), len(self.latencies) - 1)]
+
+    def as_dict(self):
+        return {
+            "bytes": self.bytes,
+            "seconds": self.seconds,
+            "throughput": self.throughput,
+            "threads": len(self.threads),
+            "parts": len(self.latencies),
+            "part_p50": self.percentile(50),
+            "part_p90": self.percentile(90),
+            "part_p99": self.percentile(99)
+        }
+
+    def __str__(self):
+        text = "{0:.1f} MB in {1:.1f}s ({2:.2f} MB/s, {3} threads)".format(
+            self.bytes / MB, self.seconds, self.throughput / MB, len(self.threads))
+        if self.latencies:
+            text += " parts p50 {0:.2f}s p90 {1:.2f}s p99 {2:.2f}s".format(
+                self.percentile(50), self.percentile(90), self.percentile(99))
+        return text
+
+
+class TransferMeter:
+    """Progress callback (boto3 Callback, MultipartWriter meter) the transfer threads barely notice.
+
+    Each thread counts into its own cell, registered once under a lock and then bumped
+    without one; the cells are only summed when rendering or asked for stats. Rendering
+    happens at most every interval seconds, by whichever thread gets there first.
+    """
+
+    def __init__(self, total=None, out=sys.stdout, interval=0.5):
+        self._total = total
+        self._out = out
+        self._interval = interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._render_lock = threading.Lock()
+        self._cells = []
+        self._started = time.monotonic()
+        self._finished = None
+        self._next_render = self._started + interval
+
+    def _cell(self):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = [0, []]
+            with self._lock:
+                self._cells.append((threading.get_ident(), cell))
+        return cell
+
+    def __call__(self, nbytes):
+        self._cell()[0] += nbytes
+        if self._out is not None and time.monotonic() >= self._next_render:
+            self._render()
+
+    def part(self, seconds):
+        """One request (a part, a range) took seconds"""
+        self._cell()[1].append(seconds)
+
+    @property
+    def transferred(self):
+        with self._lock:
+            return sum(cell[0] for _, cell in self._cells)
+
+    @property
+    def thread_info(self):
+        info = {}
+        with self._lock:
+            for ident, cell in self._cells:
+                info[ident] = info.get(ident, 0) + cell[0]
+        return info
+
+    def stats(self):
+        with self._lock:
+            latencies = [latency for _, cell in self._cells for latency in cell[1]]
+        end = self._finished or time.monotonic()
+        return TransferStats(self.transferred, end - self._started, self.thread_info, latencies)
+
+    def _render(self, final=False):
+        if not self._render_lock.acquire(blocking=False):
+            return  # someone else is drawing
+        try:
+            now = time.monotonic()
+            if not final and now < self._next_render:
+                return
+            self._next_render = now + self._interval
+            stats = self.stats()
+            line = "\r{0:.1f}".format(stats.bytes / MB)
+            if self._total:
+                line += " of {0:.1f} MB ({1:.1f}%)".format(self._total / MB, 100 * stats.bytes / self._total)
+            else:
+                line += " MB"
+            line += " {0:.2f} MB/s".format(stats.throughput / MB)
+            if self._total and stats.throughput > 0 and not final:
+                line += " ETA {0:.0f}s".format(max(self._total - stats.bytes, 0) / stats.throughput)
+            if stats.latencies:
+                line += " part p50 {0:.2f}s p99 {1:.2f}s".format(stats.percentile(50), stats.percentile(99))
+            self._out.write(line + ("\n" if final else ""))
+            self._out.flush()
+        finally:
+            self._render_lock.release()
+
+    def finish(self):
+        self._finished = time.monotonic()
+        if self._out is not None:
+            self._render(final=True)
+        return self.stats()
+
+
+class MultipartWriter:
+    """File-like sink that turns written bytes into concurrent S3 multipart part uploads.
+
+    Parts are cut as soon as part_size bytes are buffered, so whoever produces the data
+    (a tar stream, stdin, ...) overlaps with the network transfer. At most 2 * concurrency
+    parts are held in memory; write() blocks once that many are in flight. With a tuner, the
+    part size and the number of parts in flight follow it as the upload goes.
+    """
+    MIN_PART_SIZE = 5 * MB
+    MAX_PARTS = 10000
+
+    def __init__(self, client, bucket_name, object_key, extra_args=None, part_size=8 * MB, concurrency=4,
+                 tuner: TransferTuner = None, meter: TransferMeter = None):
+        self._client = client
+        self._bucket = bucket_name
+        self._key = object_key
+        self._part_size = max(part_size, MultipartWriter.MIN_PART_SIZE)
+        self._concurrency = concurrency
+        self._tuner = tuner
+        self._meter = meter
+        self._buffer = bytearray()
+        self._futures = []
+        self._next_part = 1
+        self._size = 0
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=TransferTuner.MAX_CONCURRENCY if tuner else concurrency)
+        self._inflight = 0
+        self._slots = threading.Condition()
+        self._logger = logging.getLogger(MultipartWriter.__name__)
+        self._started = time.monotonic()
+        response = client.create_multipart_upload(Bucket=bucket_name, Key=object_key, **(extra_args or {}))
+        self._upload_id = response['UploadId']
+
+    @property
+    def size(self):
+        return self._size
+
+    def writable(self):
+        return True
+
+    def _current_part_size(self):
+        if self._tuner is None:
+            return self._part_size
+        # parts may differ in size, but the upload must not run out of part numbers
+        return max(self._tuner.part_size, MultipartWriter.MIN_PART_SIZE,
+                   self._size // (MultipartWriter.MAX_PARTS // 10))
+
+    def _current_concurrency(self):
+        return self._tuner.concurrency if self._tuner else 2 * self._concurrency
+
+    def write(self, data):
+        self._buffer += data
+        self._size += len(data)
+        part_size = self._current_part_size()
+        while len(self._buffer) >= part_size:
+            self._submit(bytes(self._buffer[:part_size]))
+            del self._buffer[:part_size]
+            part_size = self._current_part_size()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, body):
+        # surface a failed part early instead of streaming the rest for nothing
+        for future in self._futures:
+            if future.done() and future.exception():
+                raise future.exception()
+        with self._slots:
+            self._slots.wait_for(lambda: self._inflight < self._current_concurrency())
+            self._inflight += 1
+        future = self._pool.submit(self._upload_part, self._next_part, body)
+        future.add_done_callback(self._release)
+        self._futures.append(future)
+        self._next_part += 1
+
+    def _release(self, future):
+        with self._slots:
+            self._inflight -= 1
+            self._slots.notify_all()
+
+    def _upload_part(self, part_number, body):
+        started = time.monotonic()
+        response = self._client.upload_part(Bucket=self._bucket,
+                                            Key=self._key,
+                                            UploadId=self._upload_id,
+                                            PartNumber=part_number,
+                                            Body=body)
+        self._logger.debug("Uploaded part %d of %s (%d bytes)", part_number, self._key, len(body))
+        if self._tuner:
+            self._tuner.observe(len(body), time.monotonic() - started)
+        if self._meter:
+            self._meter(len(body))
+            self._meter.part(time.monotonic() - started)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            # the last part may be smaller than the minimum, an empty object is a single empty part
+            if self._buffer or self._next_part == 1:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            parts = [future.result() for future in self._futures]
+            self._client.complete_multipart_upload(Bucket=self._bucket,
+                                                   Key=self._key,
+                                                   UploadId=self._upload_id,
+                                                   MultipartUpload={'Parts': parts})
+        except BaseException:
+            self._abort()
+            raise
+        finally:
+            self._pool.shutdown(wait=True)
+        record_throughput("upload", self._size, time.monotonic() - self._started)
+        if self._tuner:
+            self._tuner.save()
+
+    def abort(self):
+        if not self._closed:
+            self._closed = True
+            self._pool.shutdown(wait=True)
+            self._abort()
+
+    def _abort(self):
+        self._client.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+        self._logger.warning("Aborted multipart upload of %s", self._key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,151 @@
+import json
+import os
+from abc import ABC, abstractmethod
+
+import objectfactory
+
+VALUE, NESTED, LIST = range(3)
+
+
+class Schema:
+    """Encoders and decoders of one registered class, generated once from its objectfactory fields.
+
+    The generated functions read and write the instance __dict__ directly, so a message is
+    not walked field by field (nor deep-copied, as Field.serialize_field does) on every send.
+    Fields may only be appended to a class; whoever does so bumps its SCHEMA, and messages
+    of an older version get the defaults of the fields they do not carry.
+    """
+    _schemas = {}
+
+    def __init__(self, cls):
+        fields = list(cls._fields.values())
+        self.cls = cls
+        self.version = getattr(cls, "SCHEMA", 1)
+        self.defaults = [field._default for field in fields]
+        self._kinds = [NESTED if isinstance(field, objectfactory.Nested)
+                       else LIST if isinstance(field, objectfactory.List) else VALUE for field in fields]
+        self._scope = {"cls": cls, "new": object.__new__, "tag": cls.__name__, "version": self.version,
+                       "keys": [field._key for field in fields], "names": [field._name for field in fields],
+                       "defaults": self.defaults, "pack": pack, "unpack": unpack, "to_dict": to_dict,
+                       "from_dict": from_dict}
+        stored = ["d.get(keys[{0}], defaults[{0}])".format(i) for i in range(len(fields))]
+        self.pack = self._reader("pack", "[tag, version, {0}]".format(", ".join(self._convert(stored, "pack"))))
+        self.to_dict = self._reader("to_dict", "{{'_type': tag, {0}}}".format(", ".join(
+            "names[{0}]: {1}".format(i, expr) for i, expr in enumerate(self._convert(stored, "to_dict")))))
+        self.unpack = self._writer("unpack", "values", ["values[{0}]".format(i) for i in range(len(fields))])
+        self.from_dict = self._writer("from_dict", "body", ["body.get(names[{0}], defaults[{0}])".format(i)
+                                                            for i in range(len(fields))])
+
+    def _convert(self, exprs, convert):
+        """nested objects go through convert as well, one by one for List fields"""
+        converted = []
+        for kind, expr in zip(self._kinds, exprs):
+            if kind == NESTED:
+                expr = "{0}({1})".format(convert, expr)
+            elif kind == LIST:
+                expr = "[{0}(v) for v in {1}]".format(convert, expr)
+            converted.append(expr)
+        return converted
+
+    def _compile(self, name, source):
+        namespace = {}
+        exec(source, dict(self._scope), namespace)
+        return namespace[name]
+
+    def _reader(self, name, result):
+        return self._compile(name, "def {0}(obj):\n    d = obj.__dict__\n    return {1}\n".format(name, result))
+
+    def _writer(self, name, arg, exprs):
+        lines = ["def {0}({1}):".format(name, arg), "    obj = new(cls)", "    d = obj.__dict__"]
+        lines += ["    d[keys[{0}]] = {1}".format(i, expr) for i, expr in enumerate(self._convert(exprs, name))]
+        lines += ["    return obj", ""]
+        return self._compile(name, "\n".join(lines))
+
+    @staticmethod
+    def of(cls):
+        schema = Schema._schemas.get(cls)
+        if schema is None:
+            schema = Schema._schemas[cls] = Schema(cls)
+        return schema
+
+    @staticmethod
+    def named(tag):
+        if tag not in objectfactory.Factory.registry:
+            raise RuntimeError("Unknown message type {0}".format(tag))
+        return Schema.of(objectfactory.Factory.registry[tag])
+
+
+def pack(obj):
+    return None if obj is None else Schema.of(type(obj)).pack(obj)
+
+
+def unpack(values):
+    if values is None:
+        return None
+    schema = Schema.named(values[0])
+    fields = values[2:]
+    if values[1] != schema.version:
+        if values[1] > schema.version:
+            raise RuntimeError("{0} version {1} is newer than this client knows ({2})".format(
+                values[0], values[1], schema.version))
+        fields = fields + schema.defaults[len(fields):]
+    return schema.unpack(fields)
+
+
+def to_dict(obj):
+    return None if obj is None else Schema.of(type(obj)).to_dict(obj)
+
+
+def from_dict(body):
+    if body is None:
+        return None
+    if "_type" not in body:
+        raise RuntimeError("Cannot infer the type of {0}".format(body))
+    return Schema.named(body["_type"]).from_dict(body)
+
+
+class Codec(ABC):
+    """Turns messages into queue bodies and back, decode reads either format"""
+    name = None
+
+    @abstractmethod
+    def encode(self, msg):
+        pass
+
+    @staticmethod
+    def decode(body):
+        if body.lstrip().startswith("["):
+            return unpack(json.loads(body))
+        return from_dict(json.loads(body))
+
+    @staticmethod
+    def named(name):
+        for codec in (JsonCodec, CompactCodec):
+            if codec.name == name:
+                return codec()
+        raise RuntimeError("Unknown codec {0}".format(name))
+
+    @staticmethod
+    def current():
+        """the codec AWSRUN_CODEC names, json by default since older workers only read json"""
+        return Codec.named(os.environ.get("AWSRUN_CODEC", JsonCodec.name))
+
+
+class JsonCodec(Codec):
+    """What objectfactory's serialize() gives: {"_type": ..., "<field>": ...}"""
+    name = "json"
+
+    def encode(self, msg):
+        return json.dumps(to_dict(msg))
+
+
+class CompactCodec(Codec):
+    """Positional ["<type>", <schema version>, <field>, ...], nested objects alike.
+
+    Still json text: SQS bodies are text, so binary would travel base64'ed, and the C json
+    parser is faster than decoding a binary format in Python.
+    """
+    name = "compact"
+
+    def encode(self, msg):
+        return json.dumps(pack(msg), separators=(",", ":"))
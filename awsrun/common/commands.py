@@ -1,14 +1,22 @@
+from __future__ import annotations
+
 import os
+import shutil
 
 import objectfactory
 from botocore.exceptions import ClientError
-from aws import S3Handler, get_file_size, SqsHandler
+import aws
 from abc import ABC, abstractmethod
 import tarfile
 import time
-import datetime
 
-from common.protocol import AWSMsg
+from common import compression
+from common.configuration import WSConfig
+from common.extractor import ParallelExtractor
+from common.manifest import WSManifest, file_digest
+from common.tarindex import TarIndex
+from common.wsindex import WorkspaceIndex
+from common.protocol import AWSMsg, IOTask, TaskCompletion
 from common import resources
 from common.resources import Path, File, Folder, S3Path, OSPath
 from utils.Meta import reconcile_meta
@@ -23,57 +31,284 @@ class Command(ABC):
 class Compress(Command):
     @staticmethod
     def is_tar(filename):
-        return filename.endswith(".tar")
+        return compression.codec_for_extension(filename) is not None
 
-    def __init__(self, tarfile: File, *required: OSPath):
+    def __init__(self, tarfile: File, *required: OSPath, codec=None, level=None, index=False,
+                 cache: WorkspaceIndex = None):
         if self.is_tar(tarfile.path):
             self._tarfile = tarfile
             self._required = required
+            # the extension decides unless a codec (or "auto") is asked for explicitly
+            self._codec = codec or compression.codec_for_extension(tarfile.path).name
+            self._level = level
+            self._index = index
+            self._cache = cache
         else:
             raise RuntimeError("Not a tarfile!!!")
 
+    @staticmethod
+    def _add(tarball, *required: OSPath):
+        tarball.dereference = True
+        for path in map(lambda c: c.path, required):
+            try:
+                tarball.add(path, filter=lambda info: None if WorkspaceIndex.ignored(info.name) else info)
+            except FileNotFoundError:
+                pass  # ignore since all cli args are treated as file paths
+
+    @staticmethod
+    def _resolve(codec, level, required, pipelined):
+        if codec == "auto":
+            return compression.choose(compression.sample(*required), aws.measured_throughput("upload"),
+                                      pipelined=pipelined)
+        return compression.codec_named(codec or compression.Plain.name), level
+
+    @staticmethod
+    def _write(stream, codec, level, *required: OSPath):
+        if codec.name == compression.Plain.name:
+            writer = stream
+        else:
+            writer = compression.BlockWriter(stream, codec, level)
+        try:
+            with tarfile.open(fileobj=writer, mode="w|") as tarball:
+                Compress._add(tarball, *required)
+        except BaseException:
+            if writer is not stream:
+                writer.abort()
+            raise
+        if writer is not stream:
+            writer.close()
+        return stream
+
+    @staticmethod
+    def archive(stream, *required: OSPath, codec=None, level=None):
+        """Write the tarball as a forward-only stream, e.g. into a pipe or a multipart upload"""
+        codec, level = Compress._resolve(codec, level, required, pipelined=True)
+        return Compress._write(stream, codec, level, *required)
+
+    def _build(self):
+        codec, level = Compress._resolve(self._codec, self._level, self._required, pipelined=False)
+        if self._index and codec.name != compression.Plain.name:
+            raise RuntimeError("Only uncompressed tarballs can be indexed!!!")
+        try:
+            with open(self._tarfile.path, "wb") as f:
+                Compress._write(f, codec, level, *self._required)
+        except BaseException:
+            # a half written tarball must not pass for a built one
+            if os.path.exists(self._tarfile.path):
+                os.remove(self._tarfile.path)
+            raise
+
     def execute(self):
-        with tarfile.open(self._tarfile.path, "w") as tarball:
-            tarball.dereference = True
-            for path in map(lambda c: c.path, self._required):
-                try:
-                    tarball.add(path)
-                except FileNotFoundError:
-                    pass  # ignore since all cli args are treated as file paths
+        if self._cache is None:
+            self._build()
+        else:
+            settings = "{0}:{1}:{2}".format(self._codec, self._level, self._index)
+            if not self._cache.restore_archive(self._cache.fingerprint(*self._required, settings=settings),
+                                               self._tarfile):
+                started = time.time_ns()
+                self._build()
+                # anything touched shortly before the build may change again within the same mtime tick
+                self._cache.store_archive(self._cache.fingerprint(*self._required, settings=settings,
+                                                                  before=started - 2 * 10 ** 9),
+                                          self._tarfile)
+        if self._index:
+            TarIndex.build(self._tarfile.path).save(TarIndex.sidecar(self._tarfile.path))
+        elif os.path.exists(TarIndex.sidecar(self._tarfile.path)):
+            # an earlier build's index would be read and uploaded with this archive
+            os.remove(TarIndex.sidecar(self._tarfile.path))
         return self._tarfile
 
 
 class Decompress(Command):
-    def __init__(self, target: Folder, tarfile: File, *filter: OSPath):
+    def __init__(self, target: Folder, tarfile: File, *filter: OSPath, workers=1, memory=64 * 1024 * 1024):
         if Compress.is_tar(tarfile.path) and os.path.exists(tarfile.path):
             self._tarfile = tarfile
             self._target = target
             self._filter = filter
+            self._workers = workers
+            self._memory = memory
         else:
             raise RuntimeError("Not a tar file!!!")
 
+    @staticmethod
+    def extract(tarball, target: Folder, *members, workers=1, memory=64 * 1024 * 1024):
+        """Extract members (all if none) from a forward-only tarball, stops reading once they are out"""
+        if workers > 1:
+            return ParallelExtractor(target, workers, memory).extract(tarball, *members)
+        wanted = set(members)
+        if not wanted:
+            tarball.extractall(target.path)
+            return target
+        for member in tarball:
+            if member.name in wanted:
+                tarball.extract(member, target.path)
+                wanted.discard(member.name)
+                if not wanted:
+                    break
+        if wanted:
+            raise KeyError("filename {0} not found".format(", ".join(sorted(wanted))))
+        return target
+
     def execute(self):
         self._target.create()
         filteredmembers = tuple(map(lambda c: c.path, self._filter))
-        with tarfile.open(self._tarfile.path, "r") as tarball:
-            if not filteredmembers:
-                tarball.extractall(self._target.path)
-            else:
-                for member in filteredmembers:
-                    tarball.extract(member, self._target.path)
+        index = TarIndex.sidecar(self._tarfile.path)
+        if filteredmembers and os.path.exists(index):
+            with open(self._tarfile.path, "rb") as f:
+                def read_range(offset, size):
+                    f.seek(offset)
+                    return f.read(size)
+                return TarIndex.load(index).extract(read_range, self._target, *filteredmembers,
+                                                    fallback=lambda: self._read_all(filteredmembers))
+        return self._read_all(filteredmembers)
+
+    def _read_all(self, filteredmembers):
+        # the codec is detected from the content, the extension is not trusted
+        with open(self._tarfile.path, "rb") as f, compression.open_tar(f) as tarball:
+            Decompress.extract(tarball, self._target, *filteredmembers, workers=self._workers, memory=self._memory)
+        return self._target
+
+
+class StreamDecompress(Command):
+    """Decompress from a forward-only stream (pipe, S3 body) without the tarball touching the disk"""
+
+    def __init__(self, target: Folder, stream, *filter: OSPath, workers=1, memory=64 * 1024 * 1024):
+        self._target = target
+        self._stream = stream
+        self._filter = filter
+        self._workers = workers
+        self._memory = memory
+
+    def execute(self):
+        self._target.create()
+        with compression.open_tar(self._stream) as tarball:
+            Decompress.extract(tarball, self._target, *map(lambda c: c.path, self._filter),
+                               workers=self._workers, memory=self._memory)
         return self._target
 
 
+class Snapshot(Command):
+    def __init__(self, manifest: File, *required: OSPath, cache: WorkspaceIndex = None):
+        self._manifest = manifest
+        self._required = required
+        self._cache = cache
+
+    def execute(self):
+        digest = self._cache.digest if self._cache else file_digest
+        WSManifest.scan(*self._required, digest=digest, ignore=WorkspaceIndex.ignored).save(self._manifest)
+        return self._manifest
+
+
 class AWSCommand(Command, ABC):
     def __init__(self, servepath: Path):
         self._serverpath = servepath
 
 
+class UploadBlobs(AWSCommand):
+    """Uploads the manifest's files the bucket doesn't already hold, keyed by their content"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, workspace: WSConfig, manifest: File):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._workspace = workspace
+        self._manifest = manifest
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        located = WSManifest.load(self._manifest).locate()
+        keys = {self._workspace.blob_key(digest): path for digest, path in located.items()}
+        missing = s3handler.missing_keys(self._bucketpath.path, keys.keys())
+        s3handler.upload_many(self._bucketpath.path, {key: keys[key] for key in missing})
+        return missing
+
+
+class Rebuild(AWSCommand):
+    """Worker side of UploadBlobs: recreates the workspace from its manifest"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, workspace: WSConfig, target: Folder):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._workspace = workspace
+        self._target = target
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        manifest_file = self._workspace.manifest
+        s3handler.download_file(self._bucketpath.path, manifest_file.key, manifest_file.path)
+        manifest = WSManifest.load(manifest_file)
+        # fetch every distinct blob once, then fan them out to their paths
+        staging = Folder(self._target.path + ".blobs").create()
+        s3handler.download_many(self._bucketpath.path,
+                                {self._workspace.blob_key(digest): os.path.join(staging.path, digest)
+                                 for digest in manifest.digests()})
+        manifest.materialize(self._target,
+                             lambda digest, dest: shutil.copyfile(os.path.join(staging.path, digest), dest))
+        staging.remove()
+        return self._target
+
+
+class SyncUp(AWSCommand):
+    """Uploads a folder under a prefix, only the files whose size/ETag differ from the bucket's"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, folder: Folder, prefix, workers=8):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._folder = folder
+        self._prefix = prefix
+        self._workers = workers
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        return s3handler.sync_up(self._folder.path, self._bucketpath.path, self._prefix, self._workers)
+
+
+class SyncDown(AWSCommand):
+    """Downloads a prefix into a folder, only the objects whose size/ETag differ from the local files"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, prefix, folder: Folder, workers=8):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._prefix = prefix
+        self._folder = folder
+        self._workers = workers
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        return s3handler.sync_down(self._bucketpath.path, self._prefix, self._folder.create().path, self._workers)
+
+
+class CleanOrphans(AWSCommand):
+    """Aborts the multipart uploads of stale local checkpoints and, with a prefix, those under it no checkpoint
+    will resume"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, prefix=None):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._prefix = prefix
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        return s3handler.clean_orphans(self._bucketpath.path, self._prefix)
+
+
 class BucketCommand(AWSCommand, ABC):
     def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path):
         super().__init__(serverpath)
         self._bucketpath = bucketpath
         self._s3file = file
+        self._stats = None
+
+    @property
+    def stats(self):
+        """TransferStats of the last execute, for the commands that move a whole file"""
+        return self._stats
+
+    def _wait(self, s3handler: aws.S3Handler, timeout, events: aws.EventQueue = None):
+        """Blocks until the object is in the bucket, on the completion event when there is a queue"""
+        key = self._s3file.key
+        wake = None if events is None else lambda seconds: events.wait(TaskCompletion.announces(key), seconds)
+        if not s3handler.wait_for_object(self._bucketpath.path, key, timeout, wake=wake):
+            raise RuntimeError("Timed out waiting for {0}".format(key))
 
 
 class Upload(BucketCommand):
@@ -81,34 +316,134 @@ class Upload(BucketCommand):
         super().__init__(serverpath, bucketpath, file)
 
     def execute(self):
-        s3handler = S3Handler(location=self._serverpath.path)
-        s3handler.upload_bucket_private(self._s3file.path,
-                                        self._bucketpath.path,
-                                        self._s3file.key,
-                                        get_file_size(self._s3file.path))
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        index = TarIndex.sidecar(self._s3file.path)
+        if os.path.exists(index):
+            # goes first, whoever sees the archive can rely on its index being there
+            s3handler.upload_many(self._bucketpath.path, {TarIndex.sidecar(self._s3file.key): index})
+        self._stats = s3handler.upload_bucket_private(self._s3file.path,
+                                                      self._bucketpath.path,
+                                                      self._s3file.key,
+                                                      aws.get_file_size(self._s3file.path))
+        return self._s3file
+
+
+class StreamUpload(BucketCommand):
+    """Tars the required paths straight into a multipart upload, no local tarball"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, *required: OSPath, codec=None):
+        super().__init__(serverpath, bucketpath, file)
+        self._required = required
+        self._codec = codec
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        with s3handler.open_multipart(self._bucketpath.path, self._s3file.key) as writer:
+            Compress.archive(writer, *self._required, codec=self._codec)
+        return self._s3file
+
+
+class PipeUpload(BucketCommand):
+    """Uploads whatever arrives on a readable stream (e.g. stdin) under the file's key"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, stream):
+        super().__init__(serverpath, bucketpath, file)
+        self._stream = stream
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        s3handler.upload_stream(self._stream, self._bucketpath.path, self._s3file.key)
         return self._s3file
 
 
 class Download(BucketCommand):
-    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, timeout):
+    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, timeout, events: aws.EventQueue = None):
         super().__init__(serverpath, bucketpath, file)
         self._timeout = timeout
+        self._events = events
 
     def execute(self):
-        s3handler = S3Handler(location=self._serverpath.path)
-        deadline = datetime.datetime.now() + datetime.timedelta(seconds=self._timeout)
-        completed = False
-        while deadline > datetime.datetime.now():
-            try:
-                s3handler.download_file(self._bucketpath.path, self._s3file.key, self._s3file.path)
-            except ClientError as e:
-                error_code = int(e.response["Error"]["Code"])
-                if error_code != 404 and error_code != 403:
-                    raise e
-                time.sleep(1)
-            else:
-                completed = True
-                break
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        self._wait(s3handler, self._timeout, self._events)
+        self._stats = s3handler.download_file(self._bucketpath.path, self._s3file.key, self._s3file.path)
+        return self._s3file
+
+
+class StreamExtract(BucketCommand):
+    """Waits for the archive like Download, then extracts it while the GET body is still arriving"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, timeout, target: Folder, *filter: OSPath,
+                 events: aws.EventQueue = None):
+        super().__init__(serverpath, bucketpath, file)
+        self._timeout = timeout
+        self._target = target
+        self._filter = filter
+        self._events = events
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        self._wait(s3handler, self._timeout, self._events)
+        body = s3handler.open_object(self._bucketpath.path, self._s3file.key)
+        try:
+            return StreamDecompress(self._target, body, *self._filter).execute()
+        finally:
+            # with a filter we may stop early, closing drops the rest of the transfer
+            body.close()
+
+
+class RangedExtract(BucketCommand):
+    """Fetches only the filtered members with Range requests, using the archive's sidecar index.
+
+    Archives without an index (or requests for everything) fall back to StreamExtract.
+    """
+
+    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, timeout, target: Folder, *filter: OSPath,
+                 events: aws.EventQueue = None):
+        super().__init__(serverpath, bucketpath, file)
+        self._timeout = timeout
+        self._target = target
+        self._filter = filter
+        self._events = events
+
+    def _fallback(self):
+        return StreamExtract(self._serverpath, self._bucketpath, self._s3file, self._timeout, self._target,
+                             *self._filter, events=self._events).execute()
+
+    def execute(self):
+        if not self._filter:
+            return self._fallback()
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        self._wait(s3handler, self._timeout, self._events)
+        try:
+            index = TarIndex.loads(s3handler.read_object(self._bucketpath.path, TarIndex.sidecar(self._s3file.key)))
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404", "AccessDenied", "403"):
+                raise e
+            return self._fallback()
+        return index.extract(lambda offset, size: s3handler.get_range(self._bucketpath.path, self._s3file.key,
+                                                                      offset, size),
+                             self._target, *map(lambda c: c.path, self._filter), fallback=self._fallback)
+
+
+class PipeDownload(BucketCommand):
+    """Waits for the object like Download and copies it to a writable stream (e.g. stdout)"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, file: S3Path, timeout, stream,
+                 events: aws.EventQueue = None):
+        super().__init__(serverpath, bucketpath, file)
+        self._timeout = timeout
+        self._stream = stream
+        self._events = events
+
+    def execute(self):
+        s3handler = aws.S3Handler(location=self._serverpath.path)
+        self._wait(s3handler, self._timeout, self._events)
+        body = s3handler.open_object(self._bucketpath.path, self._s3file.key)
+        try:
+            shutil.copyfileobj(body, self._stream, 1024 * 1024)
+        finally:
+            body.close()
+        self._stream.flush()
         return self._s3file
 
 
@@ -117,13 +452,97 @@ class QueueCommand(AWSCommand, ABC):
         super().__init__(serverpath)
         self._qpath = queuepath
 
+    def _handler(self, bucketpath: Path = None):
+        """With a bucketpath, bodies too large for the queue travel through the bucket"""
+        claims = aws.ClaimCheck(self._serverpath.path, bucketpath.path) if bucketpath else None
+        return aws.SqsHandler(self._serverpath.path, claims)
+
 
 class SendMsg(QueueCommand):
     def execute(self):
-        sqs = SqsHandler(self._serverpath.path)
+        sqs = self._handler(self._bucketpath)
         queue = sqs.get_queue_by_url(self._qpath.path)
-        return sqs.send_message(queue,self._msg.flatten())
+        return sqs.send_message(queue, self._msg.flatten(), {}, self._msg.group_id(), self._msg.dedup_id())
 
-    def __init__(self, serverpath: Path, queuepath: resources.URL, msg: AWSMsg):
+    def __init__(self, serverpath: Path, queuepath: resources.URL, msg: AWSMsg, bucketpath: Path = None):
         super().__init__(serverpath, queuepath)
         self._msg = msg
+        self._bucketpath = bucketpath
+
+
+class SendBatch(QueueCommand):
+    """Sends the messages through an SqsProducer, batched as the SQS limits allow"""
+
+    def __init__(self, serverpath: Path, queuepath: resources.URL, *msgs: AWSMsg, bucketpath: Path = None):
+        super().__init__(serverpath, queuepath)
+        self._msgs = msgs
+        self._bucketpath = bucketpath
+
+    def execute(self):
+        sqs = self._handler(self._bucketpath)
+        queue = sqs.get_queue_by_url(self._qpath.path)
+        with aws.SqsProducer(sqs, queue, max_buffer=len(self._msgs) or 1) as producer:
+            sent = [producer.send(msg.flatten(), None, msg.group_id(), msg.dedup_id()) for msg in self._msgs]
+        return [future.result() for future in sent]
+
+
+class TopicCommand(AWSCommand, ABC):
+    def __init__(self, serverpath: Path, topicpath: Path):
+        super().__init__(serverpath)
+        self._topicpath = topicpath
+
+
+class Listen(TopicCommand):
+    """Sets up (or reuses) this client's queue for completion events of the topic"""
+
+    def execute(self):
+        return aws.EventQueue(self._serverpath.path, self._topicpath.path)
+
+
+class NotifyCompletion(TopicCommand):
+    """Worker side: announces that the task's output archive is in the bucket"""
+
+    def __init__(self, serverpath: Path, topicpath: Path, task: IOTask):
+        super().__init__(serverpath, topicpath)
+        self._task = task
+
+    def execute(self):
+        if not self._task.client:
+            return None  # the client did not subscribe, it finds the output by polling
+        topic = aws.sns_resource(self._serverpath.path).Topic(self._topicpath.path)
+        return aws.publish_message(topic, TaskCompletion(self._task.output.key).flatten(),
+                               {"client": self._task.client})
+
+
+class ClaimTask(AWSCommand):
+    """Worker side: True if this worker should run the task, False if another delivery of it ran or runs"""
+    # the lease covers the task's timeout plus its transfers
+    LEASE_GRACE = 600
+
+    def __init__(self, serverpath: Path, bucketpath: Path, task: AWSMsg, owner):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._task = task
+        self._owner = owner
+
+    def execute(self):
+        ledger = aws.TaskLedger(self._serverpath.path, self._bucketpath.path)
+        return ledger.claim(self._task.dedup_id(), self._owner, self._task.runtime + ClaimTask.LEASE_GRACE)
+
+
+class SettleTask(AWSCommand):
+    """Worker side: records a claimed task as done, or releases it so a redelivery runs it again"""
+
+    def __init__(self, serverpath: Path, bucketpath: Path, task: AWSMsg, owner, succeeded=True):
+        super().__init__(serverpath)
+        self._bucketpath = bucketpath
+        self._task = task
+        self._owner = owner
+        self._succeeded = succeeded
+
+    def execute(self):
+        ledger = aws.TaskLedger(self._serverpath.path, self._bucketpath.path)
+        if self._succeeded:
+            ledger.done(self._task.dedup_id(), self._owner)
+        else:
+            ledger.release(self._task.dedup_id())
@@ -0,0 +1,242 @@
+import gzip
+import io
+import lzma
+import os
+import tarfile
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from common.resources import OSPath
+
+MB = 1024 * 1024
+
+
+class Codec(ABC):
+    name = None
+    magic = b""
+    extensions = ()
+    default_level = None
+    # levels worth trying when the codec is picked automatically
+    candidate_levels = ()
+
+    @abstractmethod
+    def compress_block(self, data: bytes, level) -> bytes:
+        """Compress one self-contained block; concatenated blocks must form a valid stream"""
+        pass
+
+    @abstractmethod
+    def reader(self, stream):
+        pass
+
+
+class Plain(Codec):
+    name = "none"
+    extensions = (".tar",)
+    candidate_levels = (None,)
+
+    def compress_block(self, data, level):
+        return data
+
+    def reader(self, stream):
+        return stream
+
+
+class Gzip(Codec):
+    name = "gzip"
+    magic = b"\x1f\x8b"
+    extensions = (".tar.gz", ".tgz")
+    default_level = 6
+    candidate_levels = (1, 6)
+
+    def compress_block(self, data, level):
+        # every block is a gzip member of its own, readers handle multi-member files
+        return gzip.compress(data, compresslevel=level, mtime=0)
+
+    def reader(self, stream):
+        return gzip.GzipFile(fileobj=stream, mode="rb")
+
+
+class Xz(Codec):
+    name = "xz"
+    magic = b"\xfd7zXZ\x00"
+    extensions = (".tar.xz", ".txz")
+    default_level = 6
+    candidate_levels = (1,)
+
+    def compress_block(self, data, level):
+        return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+    def reader(self, stream):
+        return lzma.LZMAFile(stream, mode="rb")
+
+
+class Zstd(Codec):
+    name = "zstd"
+    magic = b"\x28\xb5\x2f\xfd"
+    extensions = (".tar.zst", ".tzst")
+    default_level = 3
+    candidate_levels = (3, 9)
+
+    def compress_block(self, data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def reader(self, stream):
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+
+
+CODECS = {codec.name: codec for codec in (Plain(), Gzip(), Xz(), Zstd())}
+
+
+def available():
+    return [codec for codec in CODECS.values() if codec.name != Zstd.name or zstandard is not None]
+
+
+def codec_named(name) -> Codec:
+    if name not in CODECS:
+        raise RuntimeError("Unknown codec {0}".format(name))
+    if name == Zstd.name and zstandard is None:
+        raise RuntimeError("zstd needs the zstandard package")
+    return CODECS[name]
+
+
+def codec_for_extension(filename) -> Codec:
+    for codec in CODECS.values():
+        if filename.endswith(codec.extensions):
+            return codec
+    return None
+
+
+def detect(head: bytes) -> Codec:
+    for codec in CODECS.values():
+        if codec.magic and head.startswith(codec.magic):
+            return codec_named(codec.name)
+    return CODECS[Plain.name]
+
+
+class _RawReader(io.RawIOBase):
+    """Lets anything with a read() (e.g. an S3 response body) sit under a BufferedReader"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._stream.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def open_tar(stream):
+    """Open a (possibly compressed) tar stream for forward reading, the codec comes from the magic bytes"""
+    if not hasattr(stream, "peek"):
+        stream = io.BufferedReader(_RawReader(stream), buffer_size=MB)
+    codec = detect(stream.peek(8)[:8])
+    return tarfile.open(fileobj=codec.reader(stream), mode="r|")
+
+
+class BlockWriter:
+    """Compresses fixed size blocks on a thread pool and writes them to out in order.
+
+    zlib, lzma and zstandard release the GIL, so blocks really compress in parallel.
+    """
+
+    def __init__(self, out, codec: Codec, level=None, block_size=4 * MB, threads=None):
+        self._out = out
+        self._codec = codec
+        self._level = codec.default_level if level is None else level
+        self._block_size = block_size
+        self._threads = threads or os.cpu_count() or 1
+        self._pool = ThreadPoolExecutor(max_workers=self._threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._submit(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, block):
+        self._pending.append(self._pool.submit(self._codec.compress_block, block, self._level))
+        # keep a couple of blocks per thread in flight, write out the oldest ones in order
+        while len(self._pending) > 2 * self._threads:
+            self._out.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        try:
+            while self._pending:
+                self._out.write(self._pending.popleft().result())
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def abort(self):
+        """Drops what is buffered or compressing, nothing more reaches out"""
+        self._buffer.clear()
+        for block in self._pending:
+            block.cancel()
+        self._pending.clear()
+        self._pool.shutdown(wait=True)
+
+
+def sample(*required: OSPath, size=2 * MB):
+    """Read a little from the head of every input, about size bytes overall"""
+    files = []
+    for path in map(lambda r: r.path, required):
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path, followlinks=True):
+                files.extend(os.path.join(root, name) for name in names)
+        elif os.path.isfile(path):
+            files.append(path)
+    chunks = []
+    share = max(size // max(len(files), 1), 64 * 1024)
+    for path in files:
+        if sum(map(len, chunks)) >= size:
+            break
+        try:
+            with open(path, "rb") as f:
+                chunks.append(f.read(share))
+        except OSError:
+            pass
+    return b"".join(chunks)
+
+
+def choose(data: bytes, bandwidth, threads=None, pipelined=False):
+    """Pick the (codec, level) that minimizes compress + transfer time per input byte.
+
+    bandwidth is the measured upload rate in bytes/s. When compression overlaps with the
+    upload the slower of the two stages wins, otherwise their costs add up.
+    """
+    threads = threads or os.cpu_count() or 1
+    best, best_cost = (CODECS[Plain.name], None), 1.0 / bandwidth
+    if not data:
+        return best
+    for codec in available():
+        for level in codec.candidate_levels:
+            if codec.name == Plain.name:
+                continue
+            start = time.perf_counter()
+            ratio = len(codec.compress_block(data, level)) / len(data)
+            cpu = len(data) * threads / max(time.perf_counter() - start, 1e-9)
+            cost = max(1.0 / cpu, ratio / bandwidth) if pipelined else 1.0 / cpu + ratio / bandwidth
+            if cost < best_cost:
+                best, best_cost = (codec, level), cost
+    return best
@@ -12,6 +12,8 @@ REGION = 'REGION'
 FILES = 'BUCKET'
 TASKS = 'TQUEUE'
 REGISTRY = 'RQUEUE'
+TOPIC = 'NTOPIC'  # optional, completion events
+INTAKE = 'IQUEUE'  # optional, fair-share scheduler in front of TQUEUE
 
 
 class AWSConfig:
@@ -54,15 +56,30 @@ class AWSConfig:
     def regpath(self):
         return Path(self._config[REGISTRY])
 
+    @property
+    def topicpath(self):
+        return Path(self._config[TOPIC]) if TOPIC in self._config else None
+
+    @property
+    def intakepath(self):
+        return Path(self._config[INTAKE]) if INTAKE in self._config else None
+
+    @property
+    def submitpath(self):
+        """where tasks are sent: the scheduler's intake if there is one, the task queue otherwise"""
+        return self.intakepath or self.taskpath
+
 
 @objectfactory.Factory.register_class
 class WSConfig(objectfactory.Serializable):
     _wsfolder = objectfactory.Field()
     _targetprefix = objectfactory.Field()
+    _dedup = objectfactory.Field(default=False)
 
-    def __init__(self, tgtprefix):
+    def __init__(self, tgtprefix, dedup=False):
         self._wsfolder = self.unique_root()
         self._targetprefix = tgtprefix
+        self._dedup = dedup
 
     @property
     def root(self):
@@ -76,6 +93,22 @@ class WSConfig(objectfactory.Serializable):
     def input(self):
         return S3Path(self.local_input, self._generate_key(self.local_input))
 
+    @property
+    def dedup(self):
+        return self._dedup
+
+    @property
+    def local_manifest(self):
+        return self._wsfolder + "_in.manifest"
+
+    @property
+    def manifest(self):
+        return S3Path(self.local_manifest, self._generate_key(self.local_manifest))
+
+    def blob_key(self, digest):
+        # blobs are shared by every workspace under the same prefix
+        return self._targetprefix + os.path.sep + "blobs" + os.path.sep + digest
+
     @property
     def local_output(self):
         return self._wsfolder + "_out.tar"
@@ -84,6 +117,13 @@ class WSConfig(objectfactory.Serializable):
     def output(self):
         return S3Path(self.local_output, self._generate_key(self.local_output))
 
+    def local_variant_output(self, index):
+        return self._wsfolder + "_out_" + str(index) + ".tar"
+
+    def variant_output(self, index):
+        """output of the index-th command of an array task, they all share the input"""
+        return S3Path(self.local_variant_output(index), self._generate_key(self.local_variant_output(index)))
+
     def _generate_key(self, path):
         return self._targetprefix + os.path.sep + self._wsfolder + os.path.sep + path
 
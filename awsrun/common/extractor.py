@@ -0,0 +1,157 @@
+import os
+import shutil
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common.resources import Folder
+
+MB = 1024 * 1024
+
+
+class ByteBudget:
+    """Counting semaphore over bytes, caps the member data held in memory at once"""
+
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self._limit)
+        with self._cond:
+            self._cond.wait_for(lambda: self._used + size <= self._limit)
+            self._used += size
+        return size
+
+    def release(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
+
+
+class ParallelExtractor:
+    """Extracts a forward-only tarball with one reader (the caller) and a pool of writers.
+
+    The reader pulls member data into memory within the byte budget and hands it to the
+    pool, which does the open/write/chmod/utime syscalls. Members larger than the budget
+    are streamed to disk by the reader itself, links and other special members wait for
+    the pending writes and go through tarfile.
+    """
+
+    BATCH_BYTES = MB
+    BATCH_MEMBERS = 64
+
+    def __init__(self, target: Folder, workers=8, memory=64 * MB):
+        self._target = target
+        self._workers = workers
+        self._budget = ByteBudget(memory)
+        self._memory = memory
+        self._folders = set()
+
+    @staticmethod
+    def _destination(root, name):
+        """Where a member goes, with the folders on the way resolved: links extracted earlier cannot lead out"""
+        folder, base = os.path.split(os.path.normpath(os.path.join(root, name)))
+        dest = os.path.join(os.path.realpath(folder), base)
+        if os.path.commonpath([root, dest]) != root:
+            raise RuntimeError("Member {0} escapes the target folder".format(name))
+        return dest
+
+    @staticmethod
+    def _open(dest):
+        """Opens a regular file for writing, a link in its place is replaced instead of followed"""
+        if os.path.islink(dest):
+            os.unlink(dest)
+        return os.fdopen(os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_NOFOLLOW", 0),
+                                 0o600), "wb")
+
+    @staticmethod
+    def _special(tarball, member, root):
+        if hasattr(tarfile, "data_filter"):
+            # rejects links pointing outside of root, on the Pythons that have extraction filters
+            tarball.extract(member, root, filter="data")
+        else:
+            tarball.extract(member, root)
+
+    @staticmethod
+    def _metadata(dest, member):
+        os.chmod(dest, member.mode)
+        os.utime(dest, (member.mtime, member.mtime))
+
+    def _makedirs(self, folder):
+        if folder not in self._folders:
+            os.makedirs(folder, exist_ok=True)
+            self._folders.add(folder)
+
+    def _store(self, batch, charged):
+        try:
+            for dest, data, member in batch:
+                self._makedirs(os.path.dirname(dest))
+                with self._open(dest) as f:
+                    f.write(data)
+                self._metadata(dest, member)
+        finally:
+            self._budget.release(charged)
+
+    @staticmethod
+    def _drain(futures):
+        for future in futures:
+            future.result()
+        futures.clear()
+
+    def extract(self, tarball, *members):
+        root = os.path.realpath(self._target.create().path)
+        wanted = set(members)
+        directories = []
+        futures = []
+        # small members travel in batches so the pool is not dominated by task overhead
+        batch, batch_bytes = [], 0
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            def submit():
+                futures.append(pool.submit(self._store, batch, self._budget.acquire(batch_bytes)))
+
+            for member in tarball:
+                if wanted and member.name not in wanted:
+                    continue
+                dest = self._destination(root, member.name)
+                if member.isdir():
+                    self._makedirs(dest)
+                    directories.append((dest, member))
+                elif member.isreg() and member.size <= self._memory:
+                    if batch_bytes + member.size > min(ParallelExtractor.BATCH_BYTES, self._memory) \
+                            or len(batch) == ParallelExtractor.BATCH_MEMBERS:
+                        submit()
+                        batch, batch_bytes = [], 0
+                    batch.append((dest, tarball.extractfile(member).read(), member))
+                    batch_bytes += member.size
+                elif member.isreg():
+                    self._makedirs(os.path.dirname(dest))
+                    with self._open(dest) as f:
+                        shutil.copyfileobj(tarball.extractfile(member), f, MB)
+                    self._metadata(dest, member)
+                else:
+                    # hard links need their target on disk
+                    if batch:
+                        submit()
+                        batch, batch_bytes = [], 0
+                    self._drain(futures)
+                    self._special(tarball, member, root)
+                if len(futures) > 4 * self._workers:
+                    # surface write errors early and keep the bookkeeping small
+                    done = [f for f in futures if f.done()]
+                    futures[:] = [f for f in futures if f not in done]
+                    self._drain(done)
+                if wanted:
+                    wanted.discard(member.name)
+                    if not wanted:
+                        break
+            if batch:
+                submit()
+            self._drain(futures)
+        if wanted and members:
+            raise KeyError("filename {0} not found".format(", ".join(sorted(wanted))))
+        # deepest first, so writing into a folder does not bump its mtime afterwards
+        for dest, member in reversed(directories):
+            self._metadata(dest, member)
+        return self._target
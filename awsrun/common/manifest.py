@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+from common.resources import File, Folder, OSPath
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """sha256 of a file, read in fixed size chunks"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class WSManifest:
+    """Content addressed description of a workspace: relative path -> (digest, size, mode).
+
+    The files themselves live as blobs keyed by their digest, so two submissions that
+    share most of their dependencies only differ in the manifest.
+    """
+    VERSION = 1
+
+    def __init__(self, entries=None):
+        self._entries = entries if entries is not None else {}
+
+    @staticmethod
+    def _normalize(path):
+        return os.path.normpath(path).lstrip(os.path.sep)
+
+    @staticmethod
+    def scan(*required: OSPath, digest=file_digest, ignore=lambda path: False):
+        manifest = WSManifest()
+        for path in map(lambda r: r.path, required):
+            if ignore(path):
+                continue
+            if os.path.isdir(path):
+                # follow links like the tarball (dereference) does
+                for root, dirs, files in os.walk(path, followlinks=True):
+                    dirs[:] = [d for d in dirs if not ignore(os.path.join(root, d))]
+                    for name in sorted(files):
+                        manifest.add(os.path.join(root, name), digest)
+            elif os.path.isfile(path):
+                manifest.add(path, digest)
+            # ignore anything else since all cli args are treated as file paths
+        return manifest
+
+    def add(self, path, digest=file_digest):
+        stat = os.stat(path)
+        self._entries[self._normalize(path)] = {
+            "digest": digest(path),
+            "size": stat.st_size,
+            "mode": stat.st_mode & 0o777
+        }
+
+    @property
+    def entries(self):
+        return self._entries
+
+    @property
+    def size(self):
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def digests(self):
+        return {entry["digest"] for entry in self._entries.values()}
+
+    def locate(self):
+        """digest -> one local path holding that content"""
+        located = {}
+        for path, entry in self._entries.items():
+            located.setdefault(entry["digest"], path)
+        return located
+
+    def save(self, file: File):
+        with open(file.path, "w") as f:
+            json.dump({"version": WSManifest.VERSION, "files": self._entries}, f, sort_keys=True)
+        return file
+
+    @staticmethod
+    def load(file: File):
+        with open(file.path, "r") as f:
+            body = json.load(f)
+        if body.get("version") != WSManifest.VERSION:
+            raise RuntimeError("Unsupported manifest version {0}".format(body.get("version")))
+        return WSManifest(body["files"])
+
+    def materialize(self, target: Folder, fetch):
+        """Rebuild the workspace under target. fetch(digest, dest) must place the blob at dest."""
+        root = os.path.realpath(target.create().path)
+        for path, entry in self._entries.items():
+            dest = os.path.realpath(os.path.join(root, path))
+            if os.path.commonpath([root, dest]) != root:
+                raise RuntimeError("Manifest entry {0} escapes the workspace".format(path))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            fetch(entry["digest"], dest)
+            os.chmod(dest, entry["mode"])
+        return target
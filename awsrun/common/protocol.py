@@ -1,10 +1,15 @@
+import hashlib
 import json
 from abc import ABC, abstractmethod
 import objectfactory
+from common.codec import Codec, unpack, to_dict
 from common.configuration import CmdConfig, WSConfig
 from common.resources import File, Folder
 from utils.Meta import reconcile_meta
 
+# message groups per submitter on a FIFO queue: a group is handed out one batch at a time
+FIFO_LANES = 8
+
 
 class IMessage(ABC):
     @abstractmethod
@@ -13,8 +18,35 @@ class IMessage(ABC):
 
 
 class AWSMsg(reconcile_meta(objectfactory.Serializable, IMessage, ABC)):
+    _codec = None
+
+    @staticmethod
+    def use_codec(name):
+        AWSMsg._codec = Codec.named(name)
+
     def flatten(self):
-        return json.dumps(self.serialize())
+        if AWSMsg._codec is None:
+            AWSMsg._codec = Codec.current()
+        return AWSMsg._codec.encode(self)
+
+    @staticmethod
+    def parse(body):
+        """the message in a queue body, whichever codec wrote it"""
+        return Codec.decode(body)
+
+    def dedup_id(self):
+        """FIFO deduplication id, None lets the queue deduplicate by the body"""
+        return None
+
+    def group_id(self):
+        """FIFO message group, None for the queue's default group"""
+        return None
+
+
+def _task_ids(identity, owner):
+    """(group, deduplication id): the id hashes what makes the task, the group spreads an owner over lanes"""
+    dedup = hashlib.sha256(json.dumps(identity).encode()).hexdigest()
+    return "{0}.{1}".format(owner or "anonymous", int(dedup[:8], 16) % FIFO_LANES), dedup
 
 
 @objectfactory.Factory.register_class
@@ -53,12 +85,20 @@ class IOTask(AWSMsg):
     _wsconfig = objectfactory.Nested()
     _localwd = objectfactory.Field()
     _pfile = objectfactory.Field()
+    _client = objectfactory.Field(default=None)
+    _index = objectfactory.Field(default=None)
+    _submitter = objectfactory.Field(default=None)
+    SCHEMA = 2
 
-    def __init__(self, cmdconfig: CmdConfig, wsconfig: WSConfig, localwd, perf_file):
+    def __init__(self, cmdconfig: CmdConfig, wsconfig: WSConfig, localwd, perf_file, client=None, index=None,
+                 submitter=None):
         self._cmdconfig = cmdconfig
         self._wsconfig = wsconfig
         self._localwd = localwd
-        self._perf_file = perf_file
+        self._pfile = perf_file
+        self._client = client
+        self._index = index
+        self._submitter = submitter
 
     @property
     def command(self):
@@ -74,8 +114,161 @@ class IOTask(AWSMsg):
 
     @property
     def perf_file(self):
-        return self._perf_file
+        return self._pfile
 
     @property
     def cores(self):
         return self.command.cores
+
+    @property
+    def client(self):
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        # set by the issuer once it listens for the completion event
+        self._client = client
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def submitter(self):
+        """who the task is run for, its FIFO message groups go by it"""
+        return self._submitter
+
+    @property
+    def core_seconds(self):
+        return self.command.cores * self.command.timeout
+
+    @property
+    def runtime(self):
+        """the longest the task may run"""
+        return self.command.timeout
+
+    def _ids(self):
+        # a resend of the task (same workspace upload) hashes the same, a new submission does not
+        cmd = self.command
+        return _task_ids([self.workspace.input.key, cmd.shell, cmd.cores, cmd.timeout, self._index],
+                         self._submitter or self._client)
+
+    def group_id(self):
+        return self._ids()[0]
+
+    def dedup_id(self):
+        return self._ids()[1]
+
+    @property
+    def output(self):
+        return self.workspace.output if self._index is None else self.workspace.variant_output(self._index)
+
+
+@objectfactory.Factory.register_class
+class ArrayTask(AWSMsg):
+    """Several commands (a parameter sweep) run against one uploaded workspace.
+
+    The issuer sends it in slices, _offset is the index of a slice's first command, so every
+    command keeps its place in the sweep and its own output (WSConfig.variant_output).
+    """
+    _commands = objectfactory.List()
+    _wsconfig = objectfactory.Nested()
+    _localwd = objectfactory.Field()
+    _pfile = objectfactory.Field()
+    _client = objectfactory.Field(default=None)
+    _offset = objectfactory.Field(default=0)
+    _submitter = objectfactory.Field(default=None)
+    SCHEMA = 2
+
+    def __init__(self, cmdconfigs=(), wsconfig: WSConfig = None, localwd=None, perf_file=None, client=None,
+                 offset=0, submitter=None):
+        self._commands = list(cmdconfigs)
+        self._wsconfig = wsconfig
+        self._localwd = localwd
+        self._pfile = perf_file
+        self._client = client
+        self._offset = offset
+        self._submitter = submitter
+
+    @property
+    def commands(self):
+        return self._commands
+
+    @property
+    def workspace(self):
+        return self._wsconfig
+
+    @property
+    def lwd(self):
+        return self._localwd
+
+    @property
+    def perf_file(self):
+        return self._pfile
+
+    @property
+    def client(self):
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def submitter(self):
+        return self._submitter
+
+    @property
+    def cores(self):
+        # a slice runs on one worker, command after command
+        return max((cmdconfig.cores for cmdconfig in self._commands), default=1)
+
+    @property
+    def core_seconds(self):
+        return sum(cmdconfig.cores * cmdconfig.timeout for cmdconfig in self._commands)
+
+    @property
+    def runtime(self):
+        return sum(cmdconfig.timeout for cmdconfig in self._commands)
+
+    def _ids(self):
+        commands = [[cmd.shell, cmd.cores, cmd.timeout] for cmd in self._commands]
+        return _task_ids([self.workspace.input.key, commands, self._offset], self._submitter or self._client)
+
+    def group_id(self):
+        return self._ids()[0]
+
+    def dedup_id(self):
+        return self._ids()[1]
+
+    def tasks(self):
+        """one IOTask per command, what the worker runs"""
+        return [IOTask(cmdconfig, self._wsconfig, self._localwd, self._pfile, self._client, self._offset + i,
+                       self._submitter)
+                for i, cmdconfig in enumerate(self._commands)]
+
+    def slices(self, size=1):
+        return [ArrayTask(self._commands[i:i + size], self._wsconfig, self._localwd, self._pfile, self._client,
+                          self._offset + i, self._submitter)
+                for i in range(0, len(self._commands), size)]
+
+
+@objectfactory.Factory.register_class
+class TaskCompletion(AWSMsg):
+    """Published by the worker once a task's output archive is in the bucket"""
+    _output = objectfactory.Field()
+
+    def __init__(self, output=None):
+        self._output = output
+
+    @property
+    def output(self):
+        return self._output
+
+    @staticmethod
+    def announces(key):
+        def match(body):
+            if isinstance(body, list):
+                body = to_dict(unpack(body))  # compact codec
+            return body.get("_type") == TaskCompletion.__name__ and body.get("_output") == key
+        return match
@@ -4,7 +4,6 @@ import shutil
 from abc import ABC, abstractmethod
 import json
 import os
-import urllib.request
 from urllib.parse import urlparse
 
 # can be used for AWSPath, BucketPath, QueuePath
@@ -135,6 +134,7 @@ class URL(Path):
             return False
 
     def read(self):
+        import urllib.request  # pulls in http and email, only needed for --configurl
         print(self.path)
         with urllib.request.urlopen(self.path) as url:
             decoded = url.read().decode()
@@ -0,0 +1,183 @@
+import heapq
+import itertools
+import logging
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import aws
+from common.protocol import AWSMsg
+
+
+class FairQueue:
+    """Weighted fair queuing of tasks across submitters, by core-seconds.
+
+    Start-time fair queuing: a task starts at the later of the virtual time and the finish of
+    its submitter's previous task, and finishes cost / weight later. Tasks leave in finish
+    order, so a submitter with a 100 task sweep gets the same share as one with a single task
+    instead of everyone waiting behind the sweep. A submitter holds at most max_pending tasks.
+    """
+
+    def __init__(self, weights=None, max_pending=50):
+        self._weights = weights or {}
+        self._max_pending = max_pending
+        self._heap = []
+        self._finish = {}
+        self._pending = {}
+        self._virtual = 0.0
+        self._order = itertools.count()
+
+    def push(self, submitter, cost, item):
+        """False, with nothing queued, once submitter has max_pending tasks waiting"""
+        if self._pending.get(submitter, 0) >= self._max_pending:
+            return False
+        start = max(self._virtual, self._finish.get(submitter, 0.0))
+        finish = start + cost / self._weights.get(submitter, 1.0)
+        self._finish[submitter] = finish
+        self._pending[submitter] = self._pending.get(submitter, 0) + 1
+        heapq.heappush(self._heap, (finish, next(self._order), start, submitter, item))
+        return True
+
+    def peek(self):
+        return self._heap[0][4]
+
+    def pop(self):
+        _, _, start, submitter, item = heapq.heappop(self._heap)
+        self._virtual = max(self._virtual, start)
+        self._pending[submitter] -= 1
+        if not self._pending[submitter]:
+            del self._pending[submitter]
+        return item
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class FairDispatcher:
+    """Passes tasks from the intake queue (IQUEUE) on to the task queue in fair order, as cores free up.
+
+    The task queue only gets what the fleet's capacity cores can start, so the order is decided
+    here and not by whoever sent first. Waiting tasks stay invisible in the intake, their
+    visibility extended every VISIBILITY / 2 seconds, and are deleted once passed on, so the tasks
+    of a dispatcher that died are back within VISIBILITY seconds. Tasks over their submitter's
+    max_pending are made visible again after retry seconds. A task passed on is taken to hold its
+    cores until its timeout runs out, or until the task queue is seen empty.
+
+    Submitters are told apart by the SenderId SQS puts on each message, the AWS identity that
+    sent it, so a student can't get a larger share by naming themselves differently.
+    """
+    VISIBILITY = 300
+    SAMPLE_SECONDS = 10
+
+    def __init__(self, sqs: aws.SqsHandler, intake, tasks, capacity, fair_queue: FairQueue = None, retry=60):
+        self._sqs = sqs
+        self._intake = intake
+        self._tasks = tasks
+        self._capacity = capacity
+        self._fair_queue = FairQueue() if fair_queue is None else fair_queue
+        self._retry = retry
+        self._logger = logging.getLogger(FairDispatcher.__name__)
+        # message id -> (message, cores, runtime, group, dedup), redeliveries replace the message
+        self._held = {}
+        # message id -> when its visibility was last set
+        self._visibility_set = {}
+        self._running = []
+        self._sampled = 0
+
+    @staticmethod
+    def submitter(message):
+        return (message.attributes or {}).get('SenderId') or "anonymous"
+
+    def _receive(self, wait):
+        messages = self._sqs.receive_messages(self._intake, 10, wait_time=wait,
+                                              visibility_timeout=FairDispatcher.VISIBILITY,
+                                              attribute_names=['SenderId'])
+        rejected = []
+        for message in messages:
+            if message.message_id in self._held:
+                # its visibility ran out after all, the new receipt is the one that counts
+                self._held[message.message_id] = (message,) + self._held[message.message_id][1:]
+                self._visibility_set[message.message_id] = time.monotonic()
+                continue
+            try:
+                task = AWSMsg.parse(self._sqs.body(message))
+                held = (message, task.cores, task.runtime, task.group_id(), task.dedup_id())
+                cost = task.core_seconds
+            except (ValueError, KeyError, AttributeError, RuntimeError):
+                # not a task we can weigh, the workers decide what to do with it
+                self._logger.warning("Passing on message %s unscheduled", message.message_id)
+                self._pass_on(message, None, message.message_id)
+                continue
+            if self._fair_queue.push(self.submitter(message), cost, message.message_id):
+                self._held[message.message_id] = held
+                self._visibility_set[message.message_id] = time.monotonic()
+            else:
+                rejected.append(message)
+        for i in range(0, len(rejected), 10):
+            self._sqs.change_visibility(self._intake, rejected[i:i + 10], self._retry)
+
+    def _pass_on(self, message, group, dedup):
+        """Sends message on to the task queue, then deletes it from the intake. False if the send
+        failed, the message stays in the intake. group and dedup only matter to a FIFO task queue"""
+        try:
+            self._sqs.send_message(self._tasks, message.body, message.message_attributes or {}, group, dedup)
+        except (ClientError, BotoCoreError):
+            return False
+        try:
+            self._sqs.delete_message(message)
+        except (ClientError, BotoCoreError):
+            # it turns up again and is passed on twice, the workers' ledger runs it once
+            self._logger.warning("Couldn't delete message %s from the intake", message.message_id)
+        return True
+
+    def _free_cores(self, now):
+        if now - self._sampled >= FairDispatcher.SAMPLE_SECONDS:
+            self._sampled = now
+            if self._sqs.get_queue_depth(self._tasks) == (0, 0):
+                self._running = []
+        self._running = [(until, cores) for until, cores in self._running if until > now]
+        return self._capacity - sum(cores for _, cores in self._running)
+
+    def dispatch(self):
+        """Passes on tasks in fair order while their cores are free, returns how many"""
+        now = time.monotonic()
+        passed = 0
+        while self._fair_queue:
+            message, cores, runtime, group, dedup = self._held[self._fair_queue.peek()]
+            # the head waits for its cores, smaller tasks behind it do not overtake it
+            if self._running and cores > self._free_cores(now):
+                break
+            if not self._pass_on(message, group, dedup):
+                # still at the head, the next round tries it again
+                break
+            self._fair_queue.pop()
+            del self._held[message.message_id]
+            del self._visibility_set[message.message_id]
+            self._running.append((now + runtime, cores))
+            passed += 1
+        return passed
+
+    def _extend(self):
+        """Keeps the held messages invisible, those half way through their visibility get it anew"""
+        now = time.monotonic()
+        due = [self._held[message_id][0] for message_id, since in self._visibility_set.items()
+               if now - since >= FairDispatcher.VISIBILITY / 2]
+        for i in range(0, len(due), 10):
+            failed = self._sqs.change_visibility(self._intake, due[i:i + 10], FairDispatcher.VISIBILITY)
+            for message in due[i:i + 10]:
+                if message not in failed:
+                    self._visibility_set[message.message_id] = now
+            for message in failed:
+                # it turns up again with a new receipt handle, _receive takes that one over
+                self._logger.warning("Couldn't extend the visibility of message %s", message.message_id)
+
+    def run(self, wait=1):
+        while True:
+            try:
+                # a long poll only when nothing is waiting for cores
+                self._receive(wait if self._fair_queue else 20)
+                self.dispatch()
+                self._extend()
+            except Exception:
+                self._logger.exception("Dispatch failed")
+                time.sleep(wait)
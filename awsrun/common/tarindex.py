@@ -0,0 +1,78 @@
+import json
+import os
+import tarfile
+
+from common.resources import Folder
+
+
+class TarIndex:
+    """Sidecar index of an uncompressed tarball: member name -> where its bytes start and how many.
+
+    With it a reader can pull single members by offset (a local seek or an HTTP Range request)
+    instead of scanning the whole archive.
+    """
+    SUFFIX = ".idx"
+
+    def __init__(self, members=None):
+        self._members = members if members is not None else {}
+
+    @staticmethod
+    def sidecar(path):
+        return path + TarIndex.SUFFIX
+
+    @staticmethod
+    def build(path):
+        members = {}
+        with tarfile.open(path, "r:") as tarball:
+            for member in tarball:
+                if member.isreg():
+                    members[member.name] = {
+                        "offset": member.offset_data,
+                        "size": member.size,
+                        "mode": member.mode,
+                        "mtime": member.mtime
+                    }
+        return TarIndex(members)
+
+    @property
+    def members(self):
+        return self._members
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self._members, f)
+        return path
+
+    @staticmethod
+    def load(path):
+        with open(path, "r") as f:
+            return TarIndex(json.load(f))
+
+    @staticmethod
+    def loads(content):
+        return TarIndex(json.loads(content))
+
+    def extract(self, read_range, target: Folder, *names, fallback=None):
+        """read_range(offset, size) -> bytes.
+
+        Names the index lacks (links, or members it never held) are left to fallback(), which reads
+        the whole archive; without one they raise KeyError like tarfile does.
+        """
+        root = os.path.realpath(target.create().path)
+        for name in names:
+            if name not in self._members:
+                if fallback is not None:
+                    return fallback()
+                raise KeyError("filename {0} not found".format(name))
+        for name in names:
+            entry = self._members[name]
+            dest = os.path.realpath(os.path.join(root, name))
+            if os.path.commonpath([root, dest]) != root:
+                raise RuntimeError("Member {0} escapes the target folder".format(name))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as f:
+                if entry["size"]:
+                    f.write(read_range(entry["offset"], entry["size"]))
+            os.chmod(dest, entry["mode"])
+            os.utime(dest, (entry["mtime"], entry["mtime"]))
+        return target
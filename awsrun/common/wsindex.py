@@ -0,0 +1,115 @@
+import hashlib
+import os
+import shutil
+import time
+
+from common.manifest import file_digest
+from common.resources import Folder, OSPath
+from utils.store import load_json, save_json
+
+
+class WorkspaceIndex:
+    """git-index like cache of a workspace, kept in <root>/.awsrun/.
+
+    Content hashes are keyed by (inode, size, mtime) so unchanged files are never re-read,
+    and the last built archives are kept by a fingerprint of the whole input set, so an
+    unchanged workspace gets its tarball back without re-tarring anything.
+    """
+    FOLDER = ".awsrun"
+    FILE = "index.json"
+    ARCHIVES = "archives"
+    KEEP_ARCHIVES = 2
+
+    def __init__(self, root: Folder):
+        self._folder = os.path.join(root.path, WorkspaceIndex.FOLDER)
+        self._path = os.path.join(self._folder, WorkspaceIndex.FILE)
+        content = load_json(self._path, {})
+        self._entries = content.get("entries", {})
+        self._archives = content.get("archives", [])
+        # files modified after this instant may still carry the mtime we recorded (racy git)
+        self._written = content.get("written", 0)
+        self._seen = {}
+
+    @staticmethod
+    def ignored(path):
+        return WorkspaceIndex.FOLDER in os.path.normpath(path).split(os.path.sep)
+
+    @staticmethod
+    def _key(stat):
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+    def _trusted(self, stat, before=None):
+        return stat.st_mtime_ns < (self._written if before is None else before)
+
+    def digest(self, path):
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry and entry[:3] == self._key(stat) and self._trusted(stat):
+            digest = entry[3]
+        else:
+            digest = file_digest(path)
+        self._seen[path] = self._key(stat) + [digest]
+        return digest
+
+    def _walk(self, *required: OSPath):
+        """(path, stat) of everything tar would visit, dereferencing links like it does"""
+        for path in map(lambda r: r.path, required):
+            if not os.path.exists(path) or self.ignored(path):
+                continue
+            yield path, os.stat(path)
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path, followlinks=True):
+                    dirs[:] = sorted(d for d in dirs if d != WorkspaceIndex.FOLDER)
+                    for name in sorted(dirs) + sorted(files):
+                        yield os.path.join(root, name), os.stat(os.path.join(root, name))
+
+    def fingerprint(self, *required: OSPath, settings="", before=None):
+        """Identity of an archive built from required, None if a file is too fresh to be trusted.
+
+        By default files must predate the last save of the index, before (ns) moves that line.
+        """
+        fingerprint = hashlib.sha256(settings.encode())
+        for path, stat in self._walk(*required):
+            if not self._trusted(stat, before):
+                return None
+            fingerprint.update("{0}\0{1}\0{2}\0".format(path, self._key(stat), stat.st_mode).encode())
+        return fingerprint.hexdigest()
+
+    def _archive_path(self, fingerprint):
+        return os.path.join(self._folder, WorkspaceIndex.ARCHIVES, fingerprint)
+
+    def restore_archive(self, fingerprint, target: OSPath):
+        if fingerprint is None or fingerprint not in self._archives:
+            return False
+        cached = self._archive_path(fingerprint)
+        if not os.path.exists(cached):
+            return False
+        self._link(cached, target.path)
+        return True
+
+    def store_archive(self, fingerprint, source: OSPath):
+        if fingerprint is None:
+            return
+        os.makedirs(os.path.dirname(self._archive_path(fingerprint)), exist_ok=True)
+        self._link(source.path, self._archive_path(fingerprint))
+        self._archives = [f for f in self._archives if f != fingerprint] + [fingerprint]
+        while len(self._archives) > WorkspaceIndex.KEEP_ARCHIVES:
+            stale = self._archive_path(self._archives.pop(0))
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    @staticmethod
+    def _link(source, target):
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def save(self):
+        # like git's index, only what this run looked at is kept
+        os.makedirs(self._folder, exist_ok=True)
+        save_json(self._path, {"written": time.time_ns(),
+                               "entries": self._seen or self._entries,
+                               "archives": self._archives})
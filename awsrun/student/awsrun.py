@@ -5,10 +5,6 @@ import sys
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from common.configuration import CmdConfig, WSConfig, AWSConfig
-from common.protocol import IOTask
-from student.tasks import AWSIssuer
-
 
 class CoreRange:
     def __init__(self, imin=1, imax=1):
@@ -33,6 +29,25 @@ class CoreRange:
         return value
 
 
+def positive_int(arg):
+    try:
+        value = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must be an integer")
+    if value < 1:
+        raise argparse.ArgumentTypeError("Must be an integer >= 1")
+    return value
+
+
+def sweep_command(cmd, value):
+    """value replaces {} in cmd, or is appended when there is no placeholder"""
+    if value is None:
+        return cmd.split()
+    if "{}" in cmd:
+        return cmd.replace("{}", value).split()
+    return cmd.split() + value.split()
+
+
 if __name__ == '__main__':
     aws_parser = argparse.ArgumentParser(description='Runs your program on AWS',
                                          epilog='Enjoy the program! :)')
@@ -80,14 +95,81 @@ if __name__ == '__main__':
                             default=1,
                             help='is this a multicore run')
 
+    aws_parser.add_argument('--sweep',
+                            type=str,
+                            nargs='+',
+                            default=None,
+                            help='run the command once per value (replacing {} or appended), sharing one upload')
+
+    aws_parser.add_argument('--sweep-cores',
+                            type=CoreRange(1, 8),
+                            nargs='+',
+                            default=None,
+                            help='run the command (or every --sweep value) with each of these core counts')
+
+    aws_parser.add_argument('--sweep-slice',
+                            type=positive_int,
+                            default=1,
+                            help='sweep commands per task message, a slice runs on a single worker')
+
     # workspace config
     aws_parser.add_argument('--prefix',
                             type=str,
                             default="submission",
                             help='prefix for job folders')
 
+    aws_parser.add_argument('--dedup',
+                            action='store_true',
+                            help='upload only the dependency files the bucket does not already have')
+
+    aws_parser.add_argument('--stream',
+                            action='store_true',
+                            help='stream the workspace tarball to S3 and the results back without local tarballs')
+
+    aws_parser.add_argument('--codec',
+                            choices=['none', 'gzip', 'xz', 'zstd', 'auto'],
+                            default='none',
+                            help='compression of the workspace tarball, auto weighs cpu speed against upload bandwidth')
+
+    aws_parser.add_argument('--no-cache',
+                            action='store_true',
+                            help='ignore the workspace index in .awsrun and re-read every dependency')
+
+    aws_parser.add_argument('--memo',
+                            choices=['local', 's3'],
+                            default=None,
+                            help='reuse the reports of an identical earlier run (same command, cores and dependency '
+                                 'content) kept in ~/.awsrun or in the bucket, single runs only')
+
+    aws_parser.add_argument('--memo-size',
+                            type=int,
+                            default=1024,
+                            help='MB of memoized reports to keep, the least recently used go first')
+
+    aws_parser.add_argument('--submitter',
+                            type=str,
+                            default=None,
+                            help='who the tasks are run for, this client by default; it groups them on a FIFO task '
+                                 'queue, the fair share of the fleet goes by the AWS identity that sends them')
+
+    aws_parser.add_argument('--transfer-profile',
+                            choices=['default', 'fast', 'slow', 'adaptive'],
+                            default=None,
+                            help='S3 part size and concurrency (AWSRUN_TRANSFER_PROFILE by default), '
+                                 'adaptive tunes them while transferring and remembers them per network')
+
     args = aws_parser.parse_args()
 
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    from aws import TransferProfile, client_id
+    from common.configuration import CmdConfig, WSConfig, AWSConfig
+    from common.protocol import IOTask, ArrayTask
+    from student.memo import LocalMemo, S3Memo, MB
+    from student.tasks import AWSIssuer
+
+    if args.transfer_profile:
+        TransferProfile.use(args.transfer_profile)
+
     print(args)
 
     if args.configurl:
@@ -100,10 +182,28 @@ if __name__ == '__main__':
                           cores=args.core,
                           depfile=args.deps)
 
-    wsconfig = WSConfig(args.prefix)
-
-    issuer = AWSIssuer(awsconfig)
-
-    task = IOTask(cmdconfig, wsconfig, args.workfolder, args.perf)
+    wsconfig = WSConfig(args.prefix, dedup=args.dedup)
+
+    memo = None
+    if args.memo == 'local':
+        memo = LocalMemo(args.memo_size * MB)
+    elif args.memo == 's3':
+        memo = S3Memo(awsconfig.serverpath, awsconfig.bucketpath, args.memo_size * MB)
+
+    submitter = args.submitter or client_id()
+
+    issuer = AWSIssuer(awsconfig, stream=args.stream, codec=args.codec, cache=not args.no_cache,
+                       slice_size=args.sweep_slice, memo=memo)
+
+    if args.sweep or args.sweep_cores:
+        cmdconfigs = [CmdConfig(cmd=sweep_command(args.cmd, value),
+                                timeout=args.timeout,
+                                cores=cores,
+                                depfile=args.deps)
+                      for value in (args.sweep or [None])
+                      for cores in (args.sweep_cores or [args.core])]
+        task = ArrayTask(cmdconfigs, wsconfig, args.workfolder, args.perf, submitter=submitter)
+    else:
+        task = IOTask(cmdconfig, wsconfig, args.workfolder, args.perf, submitter=submitter)
 
     issuer.issue(task)
@@ -0,0 +1,142 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+import tempfile
+from abc import ABC, abstractmethod
+
+import aws
+from botocore.exceptions import ClientError
+from common.manifest import WSManifest, file_digest
+from common.protocol import IOTask
+from common.resources import File, Folder, Path
+from common.wsindex import WorkspaceIndex
+from utils.store import state_dir
+
+MB = 1024 * 1024
+
+
+def memo_key(task: IOTask, deps, index: WorkspaceIndex = None):
+    """What decides the result of a task: its command, its core count and timeout and the content of its dependencies.
+
+    The reports do not tell whether the run was cut short, so a run under another timeout is another result.
+    """
+    manifest = WSManifest.scan(*deps, digest=index.digest if index else file_digest, ignore=WorkspaceIndex.ignored)
+    identity = {"cmd": task.command.shell, "cores": task.command.cores, "timeout": task.command.timeout,
+                "deps": manifest.entries}
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+
+class ResultMemo(ABC):
+    """Reports of finished tasks by memo key, one tar per task.
+
+    Once the stored archives exceed limit bytes the least recently used ones are dropped.
+    """
+
+    def __init__(self, limit):
+        self._limit = limit
+
+    @abstractmethod
+    def recall(self, key, target: Folder):
+        """Places the reports stored for key in target, False if there are none"""
+        pass
+
+    @abstractmethod
+    def store(self, key, *reports: File):
+        pass
+
+    @staticmethod
+    def _pack(*reports: File):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for report in reports:
+                tar.add(report.path, arcname=report.name)
+        return buffer.getvalue()
+
+    @staticmethod
+    def _unpack(data, target: Folder):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for member in tar:
+                if member.isreg():
+                    with open(os.path.join(target.path, os.path.basename(member.name)), "wb") as f:
+                        f.write(tar.extractfile(member).read())
+
+    def _evict(self, entries):
+        """entries maps key -> (size, last use), returns the keys to drop, oldest first"""
+        total = sum(size for size, _ in entries.values())
+        dropped = []
+        for key in sorted(entries, key=lambda k: entries[k][1]):
+            if total <= self._limit:
+                break
+            total -= entries[key][0]
+            dropped.append(key)
+        return dropped
+
+
+class LocalMemo(ResultMemo):
+    """Archives in the state folder, the file mtime is the last use"""
+
+    def __init__(self, limit=1024 * MB, folder=None):
+        super().__init__(limit)
+        self._folder = folder or state_dir("results")
+
+    def _path(self, key):
+        return os.path.join(self._folder, key + ".tar")
+
+    def recall(self, key, target: Folder):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return False
+        os.utime(self._path(key))
+        self._unpack(data, target)
+        return True
+
+    def store(self, key, *reports: File):
+        fd, tmp = tempfile.mkstemp(dir=self._folder, prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._pack(*reports))
+        os.replace(tmp, self._path(key))
+        self._trim()
+
+    def _trim(self):
+        entries = {}
+        for name in os.listdir(self._folder):
+            if name.endswith(".tar"):
+                stat = os.stat(os.path.join(self._folder, name))
+                entries[name[:-len(".tar")]] = (stat.st_size, stat.st_mtime)
+        for key in self._evict(entries):
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass  # another run got to it first
+
+
+class S3Memo(ResultMemo):
+    """Archives in the bucket under results/<client id>/, LastModified is the last use"""
+    PREFIX = "results"
+
+    def __init__(self, serverpath: Path, bucketpath: Path, limit=1024 * MB):
+        super().__init__(limit)
+        self._s3 = aws.S3Handler(location=serverpath.path)
+        self._bucket = bucketpath.path
+        self._prefix = "{0}/{1}/".format(S3Memo.PREFIX, aws.client_id())
+
+    def recall(self, key, target: Folder):
+        try:
+            data = self._s3.read_object(self._bucket, self._prefix + key + ".tar")
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise e
+            return False
+        self._s3.touch_object(self._bucket, self._prefix + key + ".tar")
+        self._unpack(data, target)
+        return True
+
+    def store(self, key, *reports: File):
+        self._s3.write_object(self._bucket, self._prefix + key + ".tar", self._pack(*reports))
+        objects = self._s3.list_objects(self._bucket, self._prefix)
+        entries = {object_key: (meta["size"], meta["modified"]) for object_key, meta in objects.items()}
+        self._s3.delete_objects(self._bucket, self._evict(entries))
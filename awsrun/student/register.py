@@ -5,10 +5,6 @@ from os import path
 import sys
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from common.configuration import AWSConfig
-from common.protocol import AWSIDRegistration
-from student.tasks import AWSIssuer
-
 if __name__ == '__main__':
     aws_parser = argparse.ArgumentParser(description='AWSID Operations ',
                                          epilog='Enjoy the program! :)')
@@ -31,6 +27,11 @@ if __name__ == '__main__':
 
     args = aws_parser.parse_args()
 
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    from common.configuration import AWSConfig
+    from common.protocol import AWSIDRegistration
+    from student.tasks import AWSIssuer
+
     if args.configurl:
         awsconfig = AWSConfig.load_url(args.configurl)
     elif args.configfile:
@@ -1,12 +1,20 @@
 import os
+import shutil
+import threading
 import time
 from abc import ABC, abstractmethod, ABCMeta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from common.commands import Compress, Upload, SendMsg, Download, Decompress
+from botocore.exceptions import ClientError
+from common.commands import Compress, Upload, SendMsg, Download, Decompress, Snapshot, UploadBlobs, \
+    StreamUpload, RangedExtract, Listen, SendBatch
 from common.configuration import AWSConfig
-from common.protocol import IOTask, AWSMsg, AWSIDRegistration
+from common.manifest import WSManifest
+from common.protocol import IOTask, AWSMsg, AWSIDRegistration, ArrayTask
 from common.resources import Folder, File, OSPath
+from common.wsindex import WorkspaceIndex
 from multipledispatch import dispatch
+from student.memo import ResultMemo, memo_key
 
 
 class Issuer(ABC):
@@ -16,8 +24,16 @@ class Issuer(ABC):
 
 
 class AWSIssuer(Issuer):
-    def __init__(self, awsconfig: AWSConfig):
+    def __init__(self, awsconfig: AWSConfig, stream=False, codec=None, cache=True, slice_size=1, gatherers=8,
+                 memo: ResultMemo = None):
         self._awsconfig = awsconfig
+        self._stream = stream
+        self._codec = codec
+        self._cache = WorkspaceIndex(Folder.cwd()) if cache else None
+        self._slice_size = slice_size
+        self._gatherers = gatherers
+        self._memo = memo
+        self._print_lock = threading.Lock()
 
     @staticmethod
     def dependencies(task: IOTask):
@@ -28,42 +44,158 @@ class AWSIssuer(Issuer):
         deps.extend(map(lambda f: cwd.relative(f), task.command.deps))
         return deps
 
-    def _operands(self, task: IOTask):
-        resources = Compress(task.workspace.input, *AWSIssuer.dependencies(task)).execute()
+    @staticmethod
+    def array_dependencies(array: ArrayTask):
+        """union of what the commands of the sweep need, they all run in the same workspace"""
+        deps = {}
+        for task in array.tasks():
+            for dep in AWSIssuer.dependencies(task):
+                deps.setdefault(dep.path, dep)
+        return list(deps.values())
+
+    def _operands(self, task, deps):
+        if task.workspace.dedup:
+            return self._dedup_operands(task, deps)
+        if self._stream and not task.perf_file:
+            # perf runs unpack the local input tarball afterwards, so they keep the file
+            uploaded = StreamUpload(self._awsconfig.serverpath, self._awsconfig.bucketpath, task.workspace.input,
+                                    *deps, codec=self._codec).execute()
+            print("Resources {0} is streamed\n".format(uploaded.key))
+            return
+        resources = Compress(task.workspace.input, *deps, codec=self._codec,
+                             cache=self._cache).execute()
+        self._save_cache()
         uploaded = Upload(self._awsconfig.serverpath, self._awsconfig.bucketpath, resources).execute()
         # Echo status back to user.
         print("Resources {0} is transfered\n".format(uploaded.path))
         time.sleep(1)
 
+    def _save_cache(self):
+        if self._cache:
+            self._cache.save()
+
+    def _dedup_operands(self, task, deps):
+        manifest = Snapshot(task.workspace.manifest, *deps, cache=self._cache).execute()
+        self._save_cache()
+        missing = UploadBlobs(self._awsconfig.serverpath, self._awsconfig.bucketpath, task.workspace,
+                              manifest).execute()
+        uploaded = Upload(self._awsconfig.serverpath, self._awsconfig.bucketpath, manifest).execute()
+        print("Resources {0} is transfered ({1} new blobs)\n".format(uploaded.path, len(missing)))
+
+    def _listen(self, task):
+        topic = self._awsconfig.topicpath
+        if topic is None:
+            return None
+        try:
+            events = Listen(self._awsconfig.serverpath, topic).execute()
+        except ClientError:
+            # e.g. no rights on the topic, the output is still found by polling
+            return None
+        task.client = events.client
+        return events
+
     def _operator(self, task: IOTask):
-        return SendMsg(self._awsconfig.serverpath, self._awsconfig.taskpath, task).execute()
+        return SendMsg(self._awsconfig.serverpath, self._awsconfig.submitpath, task,
+                       bucketpath=self._awsconfig.bucketpath).execute()
 
-    def _clean_files(self, task: IOTask):
-        os.remove(task.workspace.local_input)
-        os.remove(task.workspace.local_output)
+    def _clean_files(self, task):
+        # which of these exist depends on how the workspace was shipped
+        for local in (task.workspace.local_input, task.workspace.local_manifest, task.workspace.local_output):
+            if os.path.exists(local):
+                os.remove(local)
 
-    def _output(self, task: IOTask):
-        retrieved = Download(self._awsconfig.serverpath, self._awsconfig.bucketpath, task.workspace.output,
-                             task.command.timeout).execute()
-        cwd = Folder(os.path.normpath(os.getcwd()))
+    def _retrieve(self, task: IOTask, target: Folder, timeout, events=None):
         # files to extract
         stdout_report = File('stdout')
         stderr_report = File('stderr')
-        target = Decompress(cwd, retrieved, stdout_report, stderr_report).execute()
+        if self._stream:
+            RangedExtract(self._awsconfig.serverpath, self._awsconfig.bucketpath, task.output,
+                          timeout, target, stdout_report, stderr_report, events=events).execute()
+        else:
+            retrieved = Download(self._awsconfig.serverpath, self._awsconfig.bucketpath, task.output,
+                                 timeout, events).execute()
+            Decompress(target, retrieved, stdout_report, stderr_report).execute()
+            retrieved.remove()
+        return target.join(stdout_report), target.join(stderr_report)
+
+    def _output(self, task: IOTask, events=None, key=None):
+        cwd = Folder(os.path.normpath(os.getcwd()))
+        stdout_report, stderr_report = self._retrieve(task, cwd, task.command.timeout, events)
+        if key:
+            self._memo.store(key, stdout_report, stderr_report)
         # report
-        target.relative(stdout_report).content(header=" STDOUT ")
-        target.relative(stderr_report).content(header=" STDERR ")
-        #
+        stdout_report.content(header=" STDOUT ")
+        stderr_report.content(header=" STDERR ")
+        self._restore_inputs(task)
+        self._clean_files(task)
+
+    def _replay(self, key):
+        """Reports a memoized result, False if there is none for key"""
+        cwd = Folder(os.path.normpath(os.getcwd()))
+        if not self._memo.recall(key, cwd):
+            return False
+        print("Result {0} is served from the memo\n".format(key[:12]))
+        cwd.join(File('stdout')).content(header=" STDOUT ")
+        cwd.join(File('stderr')).content(header=" STDERR ")
+        return True
+
+    def _restore_inputs(self, task):
         if task.perf_file:
-            Decompress(task.lwd.relative(task.workspace.root).create(), task.workspace.local_input).execute()
+            inputs = Folder(os.path.join(task.lwd, task.workspace.root.path))
+            if task.workspace.dedup:
+                manifest = WSManifest.load(File(task.workspace.local_manifest))
+                located = manifest.locate()
+                manifest.materialize(inputs, lambda digest, dest: shutil.copyfile(located[digest], dest))
+            else:
+                Decompress(inputs.create(), File(task.workspace.local_input)).execute()
 
-        self._clean_files(task)
+    def _collect(self, task: IOTask, timeout, events):
+        target = Folder(os.path.join(os.getcwd(), "sweep", str(task.index))).create()
+        stdout_report, stderr_report = self._retrieve(task, target, timeout, events)
+        with self._print_lock:
+            stdout_report.content(header=" STDOUT [{0}] {1} ".format(task.index, " ".join(task.command.shell)))
+            stderr_report.content(header=" STDERR [{0}] ".format(task.index))
+
+    def _gather(self, array: ArrayTask, events=None):
+        """Waits for all outputs at once and reports them as they come, each in sweep/<index>/"""
+        tasks = array.tasks()
+        # the fleet may run the commands one after another, allow for it
+        timeout = sum(task.command.timeout for task in tasks)
+        failed = 0
+        with ThreadPoolExecutor(max_workers=min(self._gatherers, len(tasks))) as pool:
+            futures = [pool.submit(self._collect, task, timeout, events) for task in tasks]
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except (RuntimeError, KeyError) as e:
+                    failed += 1
+                    print(e)
+        if failed:
+            print("{0} of {1} commands did not report back".format(failed, len(tasks)))
 
     @dispatch(IOTask)
     def issue(self, task):
-        self._operands(task)
+        deps = AWSIssuer.dependencies(task)
+        key = memo_key(task, deps, self._cache) if self._memo else None
+        if key and self._replay(key):
+            self._save_cache()
+            return
+        self._operands(task, deps)
+        # subscribe before sending the task so the completion event cannot be missed
+        events = self._listen(task)
         self._operator(task)
-        self._output(task)
+        self._output(task, events, key)
+
+    @dispatch(ArrayTask)
+    def issue(self, array):
+        # one workspace upload for the whole sweep
+        self._operands(array, AWSIssuer.array_dependencies(array))
+        events = self._listen(array)
+        SendBatch(self._awsconfig.serverpath, self._awsconfig.submitpath, *array.slices(self._slice_size),
+                  bucketpath=self._awsconfig.bucketpath).execute()
+        self._gather(array, events)
+        self._restore_inputs(array)
+        self._clean_files(array)
 
     @dispatch(AWSIDRegistration)
     def issue(self, reg):
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import argparse
+from os import path
+import sys
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+INSTANCE_TYPES = ['nano', 'micro', 'small', 'medium', 'large', 'xlarge', 'x2large']
+
+if __name__ == '__main__':
+    aws_parser = argparse.ArgumentParser(description='Sizes the worker fleet to the task queue',
+                                         epilog='Enjoy the program! :)')
+    # aws config
+    awscfg = aws_parser.add_mutually_exclusive_group(required=True)
+
+    awscfg.add_argument('--configurl',
+                        action='store_const',
+                        const="https://raw.githubusercontent.com/eec-ucd/eec289/main/config.aws",
+                        help='configuration url for the aws server')
+
+    awscfg.add_argument('--configfile',
+                        action='store_const',
+                        const='config.aws',
+                        help='configuration file for the aws server')
+
+    # fleet template
+    aws_parser.add_argument('--tag', type=str, nargs=2, default=['type', 'worker'], metavar=('KEY', 'VALUE'),
+                            help="tag of the fleet's instances, new ones get it too")
+    aws_parser.add_argument('--image', type=str, required=True, help="AMI of the workers")
+    aws_parser.add_argument('--instance-type', choices=INSTANCE_TYPES, default='medium', help="t2 size of the workers")
+    aws_parser.add_argument('--key-name', type=str, required=True, help="key pair of the workers")
+    aws_parser.add_argument('--security-group', type=str, required=True, help="security group id of the workers")
+    aws_parser.add_argument('--subnet', type=str, required=True, help="subnet id of the workers")
+    aws_parser.add_argument('--userdata', type=str, default='', help="file with the user data of the workers")
+
+    # policy
+    aws_parser.add_argument('--target-wait', type=float, default=60, help="seconds a task may wait in the queue")
+    aws_parser.add_argument('--task-seconds', type=float, default=60, help="mean run time of a task")
+    aws_parser.add_argument('--slots', type=int, default=None, help="tasks a worker runs at once, its cpus by default")
+    aws_parser.add_argument('--min', type=int, default=0, help="workers to keep at least")
+    aws_parser.add_argument('--max', type=int, default=10, help="workers to run at most")
+    aws_parser.add_argument('--max-cost', type=float, default=None, help="dollars per hour the fleet may cost")
+    aws_parser.add_argument('--price', type=float, default=None, help="dollars per hour of one worker")
+    aws_parser.add_argument('--up-cooldown', type=float, default=60, help="seconds between launches")
+    aws_parser.add_argument('--down-cooldown', type=float, default=300, help="seconds after any change before shrinking")
+    aws_parser.add_argument('--interval', type=float, default=30, help="seconds between samples")
+    aws_parser.add_argument('--dry-run', action='store_true', help="only log what would be launched or terminated")
+
+    args = aws_parser.parse_args()
+
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    import logging
+    from aws import FleetAutoscaler, FleetPolicy, FleetTemplate, SqsHandler
+    from aws.aws_ec2 import EC2Launcher, T2Instances
+    from common.configuration import AWSConfig
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if args.configurl:
+        awsconfig = AWSConfig.load_url(args.configurl)
+    elif args.configfile:
+        awsconfig = AWSConfig.load_file(args.configfile)
+
+    userdata = ''
+    if args.userdata:
+        with open(args.userdata, 'r') as f:
+            userdata = f.read()
+
+    instance_type = getattr(T2Instances, args.instance_type)()
+    template = FleetTemplate(args.key_name, args.security_group, args.subnet, args.image, instance_type, userdata)
+    policy = FleetPolicy(target_wait=args.target_wait, task_seconds=args.task_seconds,
+                         slots=args.slots or instance_type.cpu, min_workers=args.min, max_workers=args.max,
+                         max_hourly_cost=args.max_cost, hourly_price=args.price,
+                         up_cooldown=args.up_cooldown, down_cooldown=args.down_cooldown)
+
+    sqs = SqsHandler(awsconfig.serverpath.path)
+    queue = sqs.get_queue_by_url(awsconfig.taskpath.path)
+    intake = sqs.get_queue_by_url(awsconfig.intakepath.path) if awsconfig.intakepath else None
+    FleetAutoscaler(EC2Launcher(tuple(args.tag)), sqs, queue, template, policy, dry_run=args.dry_run,
+                    intake=intake).run(args.interval)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+import argparse
+from os import path
+import sys
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def report(name, samples, unit="s"):
+    print("{0:<28} best {1:9.4f}{3}  median {2:9.4f}{3}".format(
+        name, min(samples), statistics.median(samples), unit))
+
+
+def synthetic_workspace(folder, files, size):
+    payload = os.urandom(size)
+    for i in range(files):
+        sub = os.path.join(folder, "d{0:03d}".format(i % 100))
+        os.makedirs(sub, exist_ok=True)
+        with open(os.path.join(sub, "f{0:06d}".format(i)), "wb") as f:
+            f.write(payload)
+
+
+def bench_extract(args):
+    from common.commands import Compress, Decompress
+    from common.resources import File, Folder
+
+    scratch = tempfile.mkdtemp(prefix="awsrun-bench-")
+    try:
+        if args.tarfile:
+            tarball = File(os.path.abspath(args.tarfile))
+        else:
+            workspace = os.path.join(scratch, "ws")
+            synthetic_workspace(workspace, args.files, args.size)
+            tarball = File(os.path.join(scratch, "bench.tar"))
+            cwd = os.getcwd()
+            os.chdir(scratch)
+            try:
+                Compress(tarball, Folder("ws")).execute()
+            finally:
+                os.chdir(cwd)
+        print("archive {0} ({1:.1f} MB)".format(tarball.path, os.path.getsize(tarball.path) / 2 ** 20))
+
+        def run(workers):
+            target = os.path.join(scratch, "out")
+            shutil.rmtree(target, ignore_errors=True)
+            Decompress(Folder(target), tarball, workers=workers, memory=args.memory * 2 ** 20).execute()
+
+        report("tarfile (1 thread)", timed(lambda: run(1), args.repeat))
+        for workers in args.workers:
+            report("parallel ({0} workers)".format(workers), timed(lambda: run(workers), args.repeat))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def bench_codec(args):
+    import json
+    from common.codec import Codec, JsonCodec, CompactCodec
+    from common.configuration import CmdConfig, WSConfig
+    from common.protocol import IOTask, ArrayTask
+
+    cmdconfig = CmdConfig(["./a.out"] + ["--arg{0}".format(i) for i in range(args.args)], 60, 4, "deps.aws")
+    messages = {
+        "IOTask": IOTask(cmdconfig, WSConfig("submission"), "/tmp/std-submissions", "perf.txt", "client", 0),
+        "ArrayTask[{0}]".format(args.sweep): ArrayTask([cmdconfig] * args.sweep, WSConfig("submission"),
+                                                       "/tmp/std-submissions", None, "client"),
+    }
+    encoders = [("serialize+json", lambda msg: json.dumps(msg.serialize())),
+                ("json codec", JsonCodec().encode), ("compact codec", CompactCodec().encode)]
+    for name, msg in messages.items():
+        print(name)
+        for label, encode in encoders:
+            body = encode(msg)
+            report("  encode {0} ({1} B)".format(label, len(body)),
+                   [sample / args.count * 1e6 for sample in timed(lambda: [encode(msg) for _ in range(args.count)],
+                                                                  args.repeat)], unit="us")
+        legacy = json.dumps(msg.serialize())
+        report("  decode json.loads only", [sample / args.count * 1e6 for sample in timed(
+            lambda: [json.loads(legacy) for _ in range(args.count)], args.repeat)], unit="us")
+        for label, encode in encoders[1:]:
+            body = encode(msg)
+            report("  decode " + label, [sample / args.count * 1e6 for sample in timed(
+                lambda: [Codec.decode(body) for _ in range(args.count)], args.repeat)], unit="us")
+
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+ENTRY_POINTS = ["student/awsrun.py", "student/register.py", "tools/uploader.py", "tools/downloader.py",
+                "tools/compressor.py", "tools/decompressor.py", "tools/autoscaler.py",
+                "tools/scheduler.py"]
+MODULES = ["aws", "aws.aws_s3", "common.protocol", "common.commands", "student.tasks"]
+
+FIRST_REQUEST = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from common.configuration import AWSConfig
+from aws import S3Handler
+config = AWSConfig.load_file({config!r})
+S3Handler(location=config.serverpath.path).s3.meta.client.head_bucket(Bucket=config.bucketpath.path)
+print(time.perf_counter() - start)
+"""
+
+
+def spawn(*argv):
+    subprocess.run([sys.executable] + list(argv), cwd=ROOT, check=False,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bench_startup(args):
+    interpreter = timed(lambda: spawn("-c", "pass"), args.repeat)
+    report("python -c pass", interpreter)
+    for script in ENTRY_POINTS:
+        report(script + " --help", timed(lambda: spawn(script, "--help"), args.repeat))
+    baseline = statistics.median(interpreter)
+    for module in MODULES:
+        samples = timed(lambda: spawn("-c", "import sys; sys.path.insert(0, '.'); import " + module), args.repeat)
+        report("import " + module, [max(0.0, sample - baseline) for sample in samples])
+    if args.configfile:
+        # measured inside the child, so the interpreter start is left out
+        code = FIRST_REQUEST.format(root=ROOT, config=path.abspath(args.configfile))
+        samples = []
+        for _ in range(args.repeat):
+            result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, check=True,
+                                    stdout=subprocess.PIPE, universal_newlines=True)
+            samples.append(float(result.stdout.split()[-1]))
+        report("first request (head_bucket)", samples)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the awsrun hot paths',
+                                     epilog='Enjoy the program! :)')
+    commands = parser.add_subparsers(dest='bench', required=True)
+
+    extract = commands.add_parser('extract', help='current tarfile extraction vs the parallel extractor')
+    extract.add_argument('--tarfile', type=str, default=None, help="archive to extract, synthetic if omitted")
+    extract.add_argument('--files', type=int, default=20000, help="files in the synthetic archive")
+    extract.add_argument('--size', type=int, default=2048, help="bytes per synthetic file")
+    extract.add_argument('--workers', type=int, nargs='+', default=[4, 8, 16], help="pool sizes to try")
+    extract.add_argument('--memory', type=int, default=64, help="MB in flight for the parallel extractor")
+    extract.add_argument('--repeat', type=int, default=3, help="runs per configuration")
+    extract.set_defaults(run=bench_extract)
+
+    startup = commands.add_parser('startup', help='entry point start up, module import and time to first request')
+    startup.add_argument('--configfile', type=str, default=None,
+                         help="aws config to time the first S3 request with, skipped if omitted")
+    startup.add_argument('--repeat', type=int, default=10, help="runs per measurement")
+    startup.set_defaults(run=bench_startup)
+
+    codec = commands.add_parser('codec', help='message encode/decode per codec, per message')
+    codec.add_argument('--count', type=int, default=10000, help="messages per run")
+    codec.add_argument('--args', type=int, default=8, help="command line arguments of the task")
+    codec.add_argument('--sweep', type=int, default=10, help="commands in the array task")
+    codec.add_argument('--repeat', type=int, default=3, help="runs per measurement")
+    codec.set_defaults(run=bench_codec)
+
+    args = parser.parse_args()
+    args.run(args)
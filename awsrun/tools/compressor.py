@@ -5,9 +5,6 @@ import sys
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from common.commands import Compress
-from common.resources import OSPath, File
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Tars your files',
                                      epilog='Enjoy the program! :)')
@@ -20,11 +17,31 @@ if __name__ == '__main__':
     parser.add_argument('--target',
                         type=str,
                         required=True,
-                        help="target tar file to create")
+                        help="target tar file to create, - streams the tarball to stdout")
+
+    parser.add_argument('--codec',
+                        choices=['none', 'gzip', 'xz', 'zstd', 'auto'],
+                        default=None,
+                        help="compression codec, defaults to the one the target extension names")
+
+    parser.add_argument('--level',
+                        type=int,
+                        default=None,
+                        help="compression level of the codec")
+
+    parser.add_argument('--index',
+                        action='store_true',
+                        help="write a member index next to the tarball for ranged member reads")
 
     args = parser.parse_args()
 
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    from common.commands import Compress
+    from common.resources import OSPath, File
+
     ospaths = tuple(map(lambda p: OSPath.new(p), args.paths))
-    target = File(args.target)
 
-    Compress(target, *ospaths).execute()
+    if args.target == '-':
+        Compress.archive(sys.stdout.buffer, *ospaths, codec=args.codec, level=args.level)
+    else:
+        Compress(File(args.target), *ospaths, codec=args.codec, level=args.level, index=args.index).execute()
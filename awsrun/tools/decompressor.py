@@ -5,9 +5,6 @@ import sys
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from common.commands import Decompress
-from common.resources import Folder, File
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Untars your files',
                                      epilog='Enjoy the program! :)')
@@ -15,7 +12,7 @@ if __name__ == '__main__':
     parser.add_argument('--tarfile',
                         type=str,
                         required=True,
-                        help="tar file to untar")
+                        help="tar file to untar, - reads the tarball from stdin; gzip/xz/zstd compression is detected")
 
     parser.add_argument('--target',
                         type=str,
@@ -27,8 +24,27 @@ if __name__ == '__main__':
                         default=[],
                         help="files to extract, if you don't specify all will be extracted")
 
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help="threads writing extracted files, 1 keeps the plain tarfile path")
+
+    parser.add_argument('--memory',
+                        type=int,
+                        default=64,
+                        help="MB of member data the workers may hold in flight")
+
     args = parser.parse_args()
 
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    from common.commands import Decompress, StreamDecompress
+    from common.resources import Folder, File
+
     filters = tuple(map(lambda f: File(f), args.files))
 
-    Decompress(Folder(args.target), File(args.tarfile), *filters).execute()
+    if args.tarfile == '-':
+        StreamDecompress(Folder(args.target), sys.stdin.buffer, *filters,
+                         workers=args.workers, memory=args.memory * 1024 * 1024).execute()
+    else:
+        Decompress(Folder(args.target), File(args.tarfile), *filters,
+                   workers=args.workers, memory=args.memory * 1024 * 1024).execute()
@@ -1,14 +1,11 @@
 #!/usr/bin/env python3
 import argparse
+import json
 from os import path
 import sys
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from common.commands import Download
-from common.configuration import AWSConfig
-from common.resources import S3Path
-
 if __name__ == '__main__':
     aws_parser = argparse.ArgumentParser(description='Download your files from S3Bucket',
                                          epilog='Enjoy the program! :)')
@@ -28,7 +25,7 @@ if __name__ == '__main__':
     aws_parser.add_argument('--path',
                             type=str,
                             required=True,
-                            help="file you want to download")
+                            help="file you want to download, - writes the object to stdout")
 
     aws_parser.add_argument('--key',
                             type=str,
@@ -40,11 +37,50 @@ if __name__ == '__main__':
                             default=60,
                             help=" time out before the download finishes")
 
+    aws_parser.add_argument('--sync',
+                            action='store_true',
+                            help="--key is a prefix and --path a folder, downloads only the objects that differ")
+
+    aws_parser.add_argument('--workers',
+                            type=int,
+                            default=8,
+                            help="files transferred at once with --sync")
+
+    aws_parser.add_argument('--stats',
+                            action='store_true',
+                            help="print the transfer statistics as json")
+
+    aws_parser.add_argument('--transfer-profile',
+                            choices=['default', 'fast', 'slow', 'adaptive'],
+                            default=None,
+                            help='S3 part size and concurrency (AWSRUN_TRANSFER_PROFILE by default), '
+                                 'adaptive tunes them while transferring and remembers them per network')
+
     args = aws_parser.parse_args()
 
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    from aws import TransferProfile
+    from common.commands import Download, PipeDownload, SyncDown
+    from common.configuration import AWSConfig
+    from common.resources import S3Path, Folder
+
+    if args.transfer_profile:
+        TransferProfile.use(args.transfer_profile)
+
     if args.configurl:
         awsconfig = AWSConfig.load_url(args.configurl)
     elif args.configfile:
         awsconfig = AWSConfig.load_file(args.configfile)
 
-    Download(awsconfig.serverpath, awsconfig.bucketpath, S3Path(args.path, args.key), args.timeout).execute()
+    if args.sync:
+        downloaded = SyncDown(awsconfig.serverpath, awsconfig.bucketpath, args.key, Folder(args.path),
+                              args.workers).execute()
+        print("{0} files downloaded".format(len(downloaded)))
+    elif args.path == '-':
+        PipeDownload(awsconfig.serverpath, awsconfig.bucketpath, S3Path(args.path, args.key), args.timeout,
+                     sys.stdout.buffer).execute()
+    else:
+        download = Download(awsconfig.serverpath, awsconfig.bucketpath, S3Path(args.path, args.key), args.timeout)
+        download.execute()
+        if args.stats:
+            print(json.dumps(download.stats.as_dict()))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import argparse
+from os import path
+import sys
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+if __name__ == '__main__':
+    aws_parser = argparse.ArgumentParser(description='Passes tasks from the intake queue to the workers, '
+                                                     'fair-shared between submitters by core-seconds',
+                                         epilog='Enjoy the program! :)')
+    # aws config
+    awscfg = aws_parser.add_mutually_exclusive_group(required=True)
+
+    awscfg.add_argument('--configurl',
+                        action='store_const',
+                        const="https://raw.githubusercontent.com/eec-ucd/eec289/main/config.aws",
+                        help='configuration url for the aws server')
+
+    awscfg.add_argument('--configfile',
+                        action='store_const',
+                        const='config.aws',
+                        help='configuration file for the aws server')
+
+    aws_parser.add_argument('--capacity', type=int, required=True, help="worker cores of the fleet")
+    aws_parser.add_argument('--max-pending', type=int, default=50, help="tasks one submitter may have waiting")
+    aws_parser.add_argument('--weight', type=str, nargs=2, action='append', default=[],
+                            metavar=('SENDER_ID', 'WEIGHT'),
+                            help="share of a submitter, by the SenderId SQS gives its messages (the IAM user or "
+                                 "role id), 1 by default")
+    aws_parser.add_argument('--retry', type=int, default=60,
+                            help="seconds before a task over --max-pending is offered again")
+    aws_parser.add_argument('--interval', type=float, default=1, help="seconds between polls while tasks wait")
+
+    args = aws_parser.parse_args()
+
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    import logging
+    from aws import SqsHandler
+    from common.configuration import AWSConfig
+    from common.scheduler import FairDispatcher, FairQueue
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if args.configurl:
+        awsconfig = AWSConfig.load_url(args.configurl)
+    elif args.configfile:
+        awsconfig = AWSConfig.load_file(args.configfile)
+
+    if awsconfig.intakepath is None:
+        raise RuntimeError("The configuration has no intake queue (IQUEUE)")
+
+    # parked bodies are read through the claim, never parked again
+    sqs = SqsHandler(awsconfig.serverpath.path)
+    intake = sqs.get_queue_by_url(awsconfig.intakepath.path)
+    tasks = sqs.get_queue_by_url(awsconfig.taskpath.path)
+    fair_queue = FairQueue({submitter: float(weight) for submitter, weight in args.weight}, args.max_pending)
+    FairDispatcher(sqs, intake, tasks, args.capacity, fair_queue, args.retry).run(args.interval)
@@ -1,15 +1,12 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
 from os import path
 import sys
 
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from common.commands import Upload
-from common.configuration import AWSConfig
-from common.resources import S3Path
-
 if __name__ == '__main__':
     aws_parser = argparse.ArgumentParser(description='Uploads your files to S3Bucket',
                                          epilog='Enjoy the program! :)')
@@ -29,18 +26,73 @@ if __name__ == '__main__':
     aws_parser.add_argument('--path',
                             type=str,
                             required=True,
-                            help="file you want to download")
+                            help="file you want to upload, - uploads stdin as it arrives")
 
     aws_parser.add_argument('--key',
                             type=str,
                             required=True,
-                            help="key of the file you want to download")
+                            help="key of the file you want to upload")
+
+    aws_parser.add_argument('--sync',
+                            action='store_true',
+                            help="--path is a folder and --key a prefix, uploads only the files that differ")
+
+    aws_parser.add_argument('--workers',
+                            type=int,
+                            default=8,
+                            help="files transferred at once with --sync")
+
+    aws_parser.add_argument('--clean',
+                            action='store_true',
+                            help="first abort this machine's multipart uploads nobody resumed for a week")
+
+    aws_parser.add_argument('--clean-prefix',
+                            type=str,
+                            default=None,
+                            help="with --clean, also abort week old uploads under this prefix of yours that no "
+                                 "local checkpoint resumes, whoever started them")
+
+    aws_parser.add_argument('--stats',
+                            action='store_true',
+                            help="print the transfer statistics as json")
+
+    aws_parser.add_argument('--transfer-profile',
+                            choices=['default', 'fast', 'slow', 'adaptive'],
+                            default=None,
+                            help='S3 part size and concurrency (AWSRUN_TRANSFER_PROFILE by default), '
+                                 'adaptive tunes them while transferring and remembers them per network')
 
     args = aws_parser.parse_args()
 
+    # imported once the arguments are valid, --help and usage errors never load boto3
+    from aws import TransferProfile
+    from common.commands import Upload, PipeUpload, SyncUp, CleanOrphans
+    from common.configuration import AWSConfig
+    from common.resources import S3Path, Folder
+
+    if args.transfer_profile:
+        TransferProfile.use(args.transfer_profile)
+
     if args.configurl:
         awsconfig = AWSConfig.load_url(args.configurl)
     elif args.configfile:
         awsconfig = AWSConfig.load_file(args.configfile)
 
-    Upload(awsconfig.serverpath, awsconfig.bucketpath, S3Path(args.path, args.key)).execute()
+    if args.clean_prefix is not None and not args.clean_prefix.strip("/"):
+        aws_parser.error("--clean-prefix must not be the whole bucket")
+
+    if args.clean:
+        aborted = CleanOrphans(awsconfig.serverpath, awsconfig.bucketpath, args.clean_prefix).execute()
+        print("{0} orphaned uploads aborted".format(len(aborted)))
+
+    if args.sync:
+        uploaded = SyncUp(awsconfig.serverpath, awsconfig.bucketpath, Folder(args.path), args.key,
+                          args.workers).execute()
+        print("{0} files uploaded".format(len(uploaded)))
+    elif args.path == '-':
+        PipeUpload(awsconfig.serverpath, awsconfig.bucketpath, S3Path(args.path, args.key), sys.stdin.buffer).execute()
+    else:
+        upload = Upload(awsconfig.serverpath, awsconfig.bucketpath, S3Path(args.path, args.key))
+        upload.execute()
+        if args.stats:
+            print(json.dumps(upload.stats.as_dict()))
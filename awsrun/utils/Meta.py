@@ -1,4 +1,5 @@
 import functools
+import threading
 
 
 def reconcile_meta(*classes):
@@ -9,12 +10,20 @@ def reconcile_meta(*classes):
 
 
 def Singleton(cls):
-    cls._state = {}
+    """Instances built with the same arguments share one state, initialized by the first of them"""
+    cls._states = {}
     orig_init = cls.__init__
+    lock = threading.Lock()
 
     def new_init(self, *args, **kwargs):
-        self.__dict__ = cls._state
-        orig_init(self, *args, **kwargs)
+        key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            state = cls._states.get(key)
+            if state is None:
+                orig_init(self, *args, **kwargs)
+                cls._states[key] = self.__dict__
+            else:
+                self.__dict__ = state
 
     cls.__init__ = new_init
     return cls
@@ -0,0 +1,33 @@
+import json
+import os
+import tempfile
+
+
+def state_dir(*parts):
+    """Per-user state folder (AWSRUN_HOME, ~/.awsrun by default), created on demand"""
+    root = os.environ.get("AWSRUN_HOME", os.path.join(os.path.expanduser("~"), ".awsrun"))
+    folder = os.path.join(root, *parts)
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def load_json(path, default=None):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, content):
+    """Write through a temp file + rename so concurrent runs never see half a file"""
+    folder = os.path.dirname(path) or "."
+    fd, tmp = tempfile.mkstemp(dir=folder, prefix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path